@@ -0,0 +1,272 @@
+# benchmarks/bench_protocol.py
+"""
+common/protocol.py 的 framing 微基準測試
+
+    python3 benchmarks/bench_protocol.py                  # 全部項目，結果印成表格
+    python3 benchmarks/bench_protocol.py --json out.json  # 另外輸出機器可讀的 JSON
+    python3 benchmarks/bench_protocol.py --quick          # 減少次數，適合 CI
+    python3 benchmarks/bench_protocol.py --baseline old.json  # 與先前結果比較，退步超過門檻時 exit code 為 1
+
+每個項目量兩件事：
+- throughput：單向連續送 N 個 frame，計算 frames/sec 與 MB/s
+- latency：一來一回 (echo) 的往返時間，取 p50 / p99 (微秒)
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from common import codec
+from common.protocol import (FramedConnection, send_frame, recv_frame, send_json, recv_json,
+                             encode_message, CODEC_JSON, CODEC_BINARY)
+
+# 從大廳的小請求到 DOWNLOAD 的 60000 bytes 分段
+FRAME_SIZES = (64, 512, 4096, 16384, 60000)
+
+
+# --- 測試資料 ---
+
+def lobby_request():
+    return {"action": "CHECK_ROOM", "room_id": "123", "req_id": 42}
+
+
+def game_state():
+    board = [[(x * 7 + y) % 8 for x in range(10)] for y in range(20)]
+    player = {"board": board, "x": 4, "y": 3, "shape": [[0, 1, 0], [1, 1, 1]], "dead": False, "score": 1200}
+    return {"cmd": "state", "p1": player, "p2": player}
+
+
+def game_list(n=200):
+    return {"status": "SUCCESS", "games": [
+        {"game_id": i, "name": f"game_{i}", "version": "1.0.%d" % i, "description": "遊戲描述 " * 8,
+         "author_username": "dev", "max_players": 2, "avg_rating": 4.25, "review_count": i}
+        for i in range(n)]}
+
+
+JSON_PAYLOADS = {
+    "lobby_request": lobby_request,
+    "game_state": game_state,
+    "game_list_200": game_list,
+}
+
+
+# --- 連線建立 ---
+
+def socketpair():
+    return socket.socketpair()
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    for s in (client, server):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client, server
+
+
+TRANSPORTS = {"socketpair": socketpair, "tcp_loopback": tcp_pair}
+
+
+# --- 收送方式 ---
+# 每個 mode 回傳 (wrap, send, recv)：wrap 把 socket 包成該 mode 使用的物件
+
+def _plain_frames():
+    return (lambda s: s), send_frame, recv_frame
+
+
+def _framed_frames():
+    return FramedConnection, (lambda c, d: c.send_frame(d)), (lambda c: c.recv_frame())
+
+
+def _json_mode(codec_name, compress, framed):
+    def wrap(s):
+        if not framed:
+            return s
+        c = FramedConnection(s)
+        c.codec, c.compress = codec_name, compress
+        return c
+    return lambda: (wrap, send_json, recv_json)
+
+
+FRAME_MODES = {
+    "send_frame/recv_frame": _plain_frames,
+    "FramedConnection": _framed_frames,
+}
+
+# mode 名稱 -> (codec, 是否壓縮, 是否使用 FramedConnection)
+JSON_MODES = {
+    "send_json/recv_json": (CODEC_JSON, False, False),
+    "FramedConnection+json": (CODEC_JSON, False, True),
+    "FramedConnection+msgpack": (CODEC_BINARY, False, True),
+    "FramedConnection+json+zlib": (CODEC_JSON, True, True),
+}
+
+
+# --- 量測 ---
+
+def measure_throughput(transport, mode, payload, count):
+    a, b = TRANSPORTS[transport]()
+    wrap, send, recv = mode()
+    tx, rx = wrap(a), wrap(b)
+
+    def writer():
+        for _ in range(count):
+            send(tx, payload)
+
+    t = threading.Thread(target=writer, daemon=True)
+    start = time.perf_counter()
+    t.start()
+    for _ in range(count):
+        recv(rx)
+    elapsed = time.perf_counter() - start
+    t.join()
+    a.close()
+    b.close()
+    return elapsed
+
+
+def measure_latency(transport, mode, payload, count):
+    a, b = TRANSPORTS[transport]()
+    wrap, send, recv = mode()
+    client, server = wrap(a), wrap(b)
+
+    def echo():
+        try:
+            for _ in range(count):
+                send(server, recv(server))
+        except (ConnectionError, OSError):
+            pass
+
+    t = threading.Thread(target=echo, daemon=True)
+    t.start()
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        send(client, payload)
+        recv(client)
+        samples.append(time.perf_counter() - start)
+    t.join()
+    a.close()
+    b.close()
+    samples.sort()
+    return {
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 2),
+        "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 2),
+        "mean_us": round(statistics.fmean(samples) * 1e6, 2),
+    }
+
+
+def run_case(kind, transport, mode_name, mode, payload_name, payload, wire_size, count, rounds):
+    # throughput 取多輪中最快的一輪，降低排程雜訊
+    elapsed = min(measure_throughput(transport, mode, payload, count) for _ in range(rounds))
+    latency = measure_latency(transport, mode, payload, max(count // 4, 50))
+    return {
+        "kind": kind,
+        "transport": transport,
+        "mode": mode_name,
+        "payload": payload_name,
+        "wire_bytes": wire_size,
+        "count": count,
+        "frames_per_sec": round(count / elapsed, 1),
+        "mb_per_sec": round(count * wire_size / elapsed / 1e6, 2),
+        **latency,
+    }
+
+
+def iter_cases(quick):
+    scale = 0.1 if quick else 1.0
+    for transport in TRANSPORTS:
+        for mode_name, mode in FRAME_MODES.items():
+            for size in FRAME_SIZES:
+                count = max(int((20000 if size <= 4096 else 4000) * scale), 100)
+                yield "frame", transport, mode_name, mode, f"{size}B", os.urandom(size), size + 4, count
+        for mode_name, (codec_name, compress, framed) in JSON_MODES.items():
+            mode = _json_mode(codec_name, compress, framed)
+            for payload_name, factory in JSON_PAYLOADS.items():
+                obj = factory()
+                wire = len(encode_message(obj, codec_name, compress)[1])
+                count = max(int((10000 if wire < 4096 else 1000) * scale), 100)
+                yield "json", transport, mode_name, mode, payload_name, obj, wire + 4, count
+
+
+def print_table(results):
+    header = f"{'transport':<13} {'mode':<27} {'payload':<14} {'frames/s':>11} {'MB/s':>9} {'p50 us':>9} {'p99 us':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['transport']:<13} {r['mode']:<27} {r['payload']:<14} {r['frames_per_sec']:>11.1f} "
+              f"{r['mb_per_sec']:>9.2f} {r['p50_us']:>9.1f} {r['p99_us']:>9.1f}")
+
+
+def case_key(r):
+    return (r["transport"], r["mode"], r["payload"])
+
+
+def compare(results, baseline_path, tolerance):
+    """與基準結果比較 frames/sec，回傳退步超過 tolerance 的項目"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get(case_key(r))
+        if old and r["frames_per_sec"] < old["frames_per_sec"] * (1 - tolerance):
+            regressions.append((r, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="protocol framing micro-benchmarks")
+    parser.add_argument("--json", metavar="PATH", help="結果輸出成 JSON；'-' 表示輸出到 stdout")
+    parser.add_argument("--quick", action="store_true", help="減少次數，快速跑完")
+    parser.add_argument("--rounds", type=int, default=3, help="throughput 量測輪數 (取最快)")
+    parser.add_argument("--filter", default="", help="只跑 mode 名稱包含此字串的項目")
+    parser.add_argument("--baseline", metavar="PATH", help="與先前 --json 輸出的結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的 frames/sec 退步比例 (預設 0.2)")
+    args = parser.parse_args()
+
+    results = []
+    for case in iter_cases(args.quick):
+        if args.filter and args.filter not in case[2]:
+            continue
+        results.append(run_case(*case, rounds=args.rounds))
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "msgpack_accelerated": codec.ACCELERATED,
+        "results": results,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"\n[完成] 結果已寫入 {args.json}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for r, old in regressions:
+            print(f"[退步] {' / '.join(case_key(r))}: {old['frames_per_sec']} -> {r['frames_per_sec']} frames/s",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# codec.py
+"""
+精簡二進位編碼 (MessagePack 相容格式)
+
+- 有安裝 msgpack 套件時直接使用 C 實作，沒有時退回下面的純 Python 版本，兩者輸出可互通
+- 額外定義一個 ext type：EXT_UINT8_ARRAY，把「全部是 0~255 整數的 list」(例如 Tetris 盤面的每一列)
+  直接用 bytes(list) 打包、list(bytes) 解開，省下逐一編碼每個格子的成本 (只有純 Python 版會這樣打包，兩邊都能解)
+- 目前只用於大廳連線 (common/protocol.py 的 HELLO 協商)；遊戲封包各自帶的 protocol.py 仍然是 JSON
+"""
+import struct
+
+EXT_UINT8_ARRAY = 1
+UINT8_ARRAY_MIN = 8   # 太短的 list 走一般編碼即可
+
+
+class ExtType:
+    def __init__(self, code, data):
+        self.code = code
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, ExtType) and (self.code, self.data) == (other.code, other.data)
+
+    def __repr__(self):
+        return f"ExtType({self.code}, {self.data!r})"
+
+
+def _as_uint8_array(obj):
+    """list 全部是 0~255 的 int (不含 bool) 時回傳 bytes，否則回傳 None"""
+    if len(obj) < UINT8_ARRAY_MIN:
+        return None
+    try:
+        data = bytes(obj)
+    except (TypeError, ValueError):
+        return None
+    if set(map(type, obj)) != {int}:
+        return None
+    return data
+
+
+# --- 純 Python 編碼 ---
+
+_pack_double = struct.Struct('>d').pack
+
+
+def _pack_int(n, out):
+    if 0 <= n <= 0x7f:
+        out.append(n)
+    elif -32 <= n < 0:
+        out.append(n & 0xff)
+    elif n > 0:
+        if n <= 0xff:
+            out += b'\xcc' + struct.pack('>B', n)
+        elif n <= 0xffff:
+            out += b'\xcd' + struct.pack('>H', n)
+        elif n <= 0xffffffff:
+            out += b'\xce' + struct.pack('>I', n)
+        elif n <= 0xffffffffffffffff:
+            out += b'\xcf' + struct.pack('>Q', n)
+        else:
+            raise ValueError(f"integer out of range: {n}")
+    else:
+        if n >= -0x80:
+            out += b'\xd0' + struct.pack('>b', n)
+        elif n >= -0x8000:
+            out += b'\xd1' + struct.pack('>h', n)
+        elif n >= -0x80000000:
+            out += b'\xd2' + struct.pack('>i', n)
+        elif n >= -0x8000000000000000:
+            out += b'\xd3' + struct.pack('>q', n)
+        else:
+            raise ValueError(f"integer out of range: {n}")
+
+
+def _pack_len(n, out, fix_tag, fix_max, tags):
+    """依長度寫入 fix / 8 / 16 / 32 bit 的長度標頭；tags 為 (8bit, 16bit, 32bit) 的 tag，None 表示不支援"""
+    if n <= fix_max:
+        out.append(fix_tag | n)
+    elif tags[0] is not None and n <= 0xff:
+        out += bytes((tags[0], n))
+    elif n <= 0xffff:
+        out += bytes((tags[1],)) + struct.pack('>H', n)
+    else:
+        out += bytes((tags[2],)) + struct.pack('>I', n)
+
+
+def _pack_ext(code, data, out):
+    n = len(data)
+    fixed = {1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8}
+    if n in fixed:
+        out += bytes((fixed[n], code & 0xff))
+    elif n <= 0xff:
+        out += bytes((0xc7, n, code & 0xff))
+    elif n <= 0xffff:
+        out += b'\xc8' + struct.pack('>Hb', n, code)
+    else:
+        out += b'\xc9' + struct.pack('>Ib', n, code)
+    out += data
+
+
+def _pack(obj, out):
+    t = type(obj)
+    if obj is None:
+        out.append(0xc0)
+    elif t is bool:
+        out.append(0xc3 if obj else 0xc2)
+    elif t is int:
+        _pack_int(obj, out)
+    elif t is str:
+        data = obj.encode('utf-8')
+        _pack_len(len(data), out, 0xa0, 31, (0xd9, 0xda, 0xdb))
+        out += data
+    elif t is float:
+        out.append(0xcb)
+        out += _pack_double(obj)
+    elif t is dict:
+        _pack_len(len(obj), out, 0x80, 15, (None, 0xde, 0xdf))
+        for k, v in obj.items():
+            _pack(k, out)
+            _pack(v, out)
+    elif t is list or t is tuple:
+        data = _as_uint8_array(obj)
+        if data is not None:
+            _pack_ext(EXT_UINT8_ARRAY, data, out)
+            return
+        _pack_len(len(obj), out, 0x90, 15, (None, 0xdc, 0xdd))
+        for item in obj:
+            _pack(item, out)
+    elif t in (bytes, bytearray, memoryview):
+        data = bytes(obj)
+        n = len(data)
+        if n <= 0xff:
+            out += bytes((0xc4, n))
+        elif n <= 0xffff:
+            out += b'\xc5' + struct.pack('>H', n)
+        else:
+            out += b'\xc6' + struct.pack('>I', n)
+        out += data
+    elif t is ExtType:
+        _pack_ext(obj.code, obj.data, out)
+    elif isinstance(obj, int):
+        _pack_int(int(obj), out)
+    else:
+        raise TypeError(f"cannot serialize {t.__name__} object")
+
+
+def _py_packb(obj) -> bytes:
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+# --- 純 Python 解碼 ---
+
+def _check_end(data, end):
+    """切片超出結尾不會報錯，長度標頭之後的內容要自己確認真的收齊了"""
+    if end > len(data):
+        raise ValueError("truncated msgpack data")
+
+
+def _read_len(data, pos, size):
+    _check_end(data, pos + size)
+    return int.from_bytes(data[pos:pos + size], 'big'), pos + size
+
+
+def _unpack_str(data, pos, n):
+    end = pos + n
+    _check_end(data, end)
+    return str(data[pos:end], 'utf-8'), end
+
+
+def _build_decoders():
+    """建立 0x00~0xff 的分派表，每個函式簽名為 f(data, pos, b) -> (obj, new_pos)"""
+    table = [None] * 256
+
+    def positive_fixint(data, pos, b):
+        return b, pos
+
+    def negative_fixint(data, pos, b):
+        return b - 0x100, pos
+
+    def fixstr(data, pos, b):
+        return _unpack_str(data, pos, b & 0x1f)
+
+    def fixarray(data, pos, b):
+        return _unpack_array(data, pos, b & 0x0f)
+
+    def fixmap(data, pos, b):
+        return _unpack_map(data, pos, b & 0x0f)
+
+    def const(value):
+        return lambda data, pos, b: (value, pos)
+
+    def fixed(st):
+        unpack_from, size = st.unpack_from, st.size
+        return lambda data, pos, b: (unpack_from(data, pos)[0], pos + size)
+
+    def sized(size, kind):
+        def decode(data, pos, b):
+            n, pos = _read_len(data, pos, size)
+            if kind == 'str':
+                return _unpack_str(data, pos, n)
+            if kind == 'bin':
+                _check_end(data, pos + n)
+                return bytes(data[pos:pos + n]), pos + n
+            if kind == 'array':
+                return _unpack_array(data, pos, n)
+            if kind == 'map':
+                return _unpack_map(data, pos, n)
+            return _unpack_ext(data, pos, n)
+        return decode
+
+    def fixext(n):
+        return lambda data, pos, b: _unpack_ext(data, pos, n)
+
+    for b in range(0x00, 0x80):
+        table[b] = positive_fixint
+    for b in range(0xe0, 0x100):
+        table[b] = negative_fixint
+    for b in range(0xa0, 0xc0):
+        table[b] = fixstr
+    for b in range(0x90, 0xa0):
+        table[b] = fixarray
+    for b in range(0x80, 0x90):
+        table[b] = fixmap
+    table[0xc0] = const(None)
+    table[0xc2] = const(False)
+    table[0xc3] = const(True)
+    for b, fmt in ((0xcc, '>B'), (0xcd, '>H'), (0xce, '>I'), (0xcf, '>Q'),
+                   (0xd0, '>b'), (0xd1, '>h'), (0xd2, '>i'), (0xd3, '>q'),
+                   (0xca, '>f'), (0xcb, '>d')):
+        table[b] = fixed(struct.Struct(fmt))
+    for b, size, kind in ((0xd9, 1, 'str'), (0xda, 2, 'str'), (0xdb, 4, 'str'),
+                          (0xc4, 1, 'bin'), (0xc5, 2, 'bin'), (0xc6, 4, 'bin'),
+                          (0xdc, 2, 'array'), (0xdd, 4, 'array'),
+                          (0xde, 2, 'map'), (0xdf, 4, 'map'),
+                          (0xc7, 1, 'ext'), (0xc8, 2, 'ext'), (0xc9, 4, 'ext')):
+        table[b] = sized(size, kind)
+    for i, b in enumerate(range(0xd4, 0xd9)):
+        table[b] = fixext(1 << i)
+    return table
+
+
+def _unpack(data, pos):
+    b = data[pos]
+    decoder = _DECODERS[b]
+    if decoder is None:
+        raise ValueError(f"unknown msgpack type byte: 0x{b:02x}")
+    return decoder(data, pos + 1, b)
+
+
+def _unpack_array(data, pos, n):
+    items = []
+    append = items.append
+    for _ in range(n):
+        b = data[pos]
+        if b <= 0x7f:   # 最常見的小整數直接處理，不進分派表
+            append(b)
+            pos += 1
+        else:
+            item, pos = _unpack(data, pos)
+            append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, n):
+    result = {}
+    for _ in range(n):
+        k, pos = _unpack(data, pos)
+        result[k], pos = _unpack(data, pos)
+    return result, pos
+
+
+def _unpack_ext(data, pos, n):
+    code = data[pos] - 0x100 if data[pos] > 0x7f else data[pos]
+    pos += 1
+    _check_end(data, pos + n)
+    payload = bytes(data[pos:pos + n])
+    if code == EXT_UINT8_ARRAY:
+        return list(payload), pos + n
+    return ExtType(code, payload), pos + n
+
+
+_DECODERS = _build_decoders()
+
+
+def _py_unpackb(data):
+    data = bytes(data)
+    try:
+        obj, pos = _unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError("truncated msgpack data") from None
+    if pos != len(data):
+        raise ValueError("extra data after msgpack object")
+    return obj
+
+
+# --- 有 msgpack 套件時使用 C 實作 ---
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+# 純 Python 版省頻寬但比 C 實作的 json 慢，協商時只有在有 C 加速時才優先選用
+ACCELERATED = _msgpack is not None
+
+
+def _ext_hook(code, data):
+    if code == EXT_UINT8_ARRAY:
+        return list(data)
+    return ExtType(code, data)
+
+
+def _default(obj):
+    if isinstance(obj, ExtType):
+        return _msgpack.ExtType(obj.code, obj.data)
+    raise TypeError(f"cannot serialize {type(obj).__name__} object")
+
+
+if _msgpack is not None:
+    def packb(obj) -> bytes:
+        return _msgpack.packb(obj, use_bin_type=True, default=_default)
+
+    def unpackb(data):
+        return _msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_ext_hook)
+else:
+    packb = _py_packb
+    unpackb = _py_unpackb
@@ -2,47 +2,478 @@
 import struct
 import socket
 import json
+import zlib
+import asyncio
+from collections import deque
+
+from common import codec
 
 MAX_LEN = 65536
+HEADER = struct.Struct('!I')
+RECV_BUFSIZE = 256 * 1024   # FramedConnection 一次 recv 的大小
+IOV_MAX = 1024              # 單次 sendmsg 最多帶幾個 buffer
 
+# header 高位元當作 frame 旗標，低 24 bits 為長度；沒有旗標時與舊版格式完全相同
+LENGTH_MASK = 0x00FFFFFF
+FLAG_BINARY = 0x80000000    # body 以 codec.packb 編碼 (MessagePack 相容)
+FLAG_COMPRESSED = 0x40000000  # body 經過 zlib 壓縮 (先編碼再壓縮)
+FLAG_MORE = 0x20000000      # 訊息超過 MAX_LEN 時切成多個 frame，除了最後一個之外都帶此旗標
+KNOWN_FLAGS = FLAG_BINARY | FLAG_COMPRESSED | FLAG_MORE
+MAX_MESSAGE_LEN = 16 * 1024 * 1024  # 單一訊息重組後 (或解壓後) 的上限，可依部署調整
 
-def send_frame(sock: socket.socket, data: bytes) -> None:
-    length = len(data)
+# 編碼協商：Client 送 HELLO 依偏好順序列出支援的 codec，Server 挑第一個自己也支援的
+# 沒有安裝 msgpack 套件時 Client 偏好 JSON，協商結果就是 JSON；只有大廳連線會協商，遊戲本身的連線不經過這裡
+CODEC_JSON = "json"
+CODEC_BINARY = "msgpack"
+SUPPORTED_CODECS = (CODEC_BINARY, CODEC_JSON)
+PREFERRED_CODECS = SUPPORTED_CODECS if codec.ACCELERATED else (CODEC_JSON, CODEC_BINARY)
+
+# 壓縮協商：同樣在 HELLO 中進行；小於門檻的 frame 壓縮不划算，維持原樣
+COMPRESS_ZLIB = "zlib"
+SUPPORTED_COMPRESSION = (COMPRESS_ZLIB,)
+COMPRESS_MIN = 1024
+COMPRESS_LEVEL = 6
+
+# 分段檔案傳輸 (transfer = "chunked")：每個 frame 開頭 8 bytes 是這段資料在檔案中的 offset
+TRANSFER_CHUNKED = "chunked"
+CHUNK_HEADER = struct.Struct('!Q')
+CHUNK_SIZE = MAX_LEN - CHUNK_HEADER.size
+
+# 原始傳輸 (transfer = "raw")：回覆中的 size 之後緊接著 size bytes 的檔案內容，不切 frame，Server 可以直接 sendfile
+TRANSFER_RAW = "raw"
+
+
+def _check_length(length: int, incoming: bool = False) -> None:
     if length <= 0 or length > MAX_LEN:
+        if incoming:
+            raise ValueError(f"invalid incoming frame length: {length}")
         raise ValueError(f"invalid frame length: {length}")
-    header = struct.pack('!I', length)
-    tosend = header + data
-    totalsent = 0
-    while totalsent < len(tosend):
-        sent = sock.send(tosend[totalsent:])
+
+
+def pack_header(length: int, flags: int = 0) -> bytes:
+    _check_length(length)
+    return HEADER.pack(flags | length)
+
+
+def split_header(value: int):
+    """header 數值 -> (flags, length)，並檢查長度與旗標"""
+    flags, length = value & ~LENGTH_MASK, value & LENGTH_MASK
+    if flags & ~KNOWN_FLAGS:
+        raise ValueError(f"unknown frame flags: {flags:#x}")
+    _check_length(length, incoming=True)
+    return flags, length
+
+
+def encode_message(obj, codec_name: str = CODEC_JSON, compress: bool = False):
+    """物件 -> (flags, body)"""
+    if codec_name == CODEC_BINARY:
+        flags, body = FLAG_BINARY, codec.packb(obj)
+    else:
+        flags, body = 0, json.dumps(obj).encode('utf-8')
+    if compress and len(body) >= COMPRESS_MIN:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            flags, body = flags | FLAG_COMPRESSED, packed
+    return flags, body
+
+
+def message_frames(flags: int, body: bytes, max_message: int = MAX_MESSAGE_LEN) -> list:
+    """
+    (flags, body) -> [header, body 切片, header, body 切片, ...]，可直接交給 sendmsg / writelines
+    超過 MAX_LEN 的訊息切成多個 frame (memoryview 切片，不複製)，每片都帶相同的 codec / 壓縮旗標
+    """
+    view = memoryview(body)
+    total = len(view)
+    if total <= MAX_LEN:
+        return [pack_header(total, flags), view]
+    if total > max_message:
+        raise ValueError(f"message too large: {total}")
+    buffers = []
+    for start in range(0, total, MAX_LEN):
+        chunk = view[start:start + MAX_LEN]
+        more = FLAG_MORE if start + MAX_LEN < total else 0
+        buffers.append(pack_header(len(chunk), flags | more))
+        buffers.append(chunk)
+    return buffers
+
+
+def _check_message_size(size: int, max_message: int) -> None:
+    if size > max_message:
+        raise ValueError(f"incoming message too large: > {max_message}")
+
+
+def decompress_body(body: bytes, max_message: int = MAX_MESSAGE_LEN) -> bytes:
+    d = zlib.decompressobj()
+    data = d.decompress(body, max_message)  # 限制輸出大小，防止惡意的壓縮炸彈
+    if d.unconsumed_tail or not d.eof:
+        raise ValueError("compressed frame too large or truncated")
+    return data
+
+
+def decode_message(flags: int, body: bytes, max_message: int = MAX_MESSAGE_LEN):
+    """依 frame 旗標解碼，因此不論對方用哪種 codec、是否壓縮都能收"""
+    if flags & FLAG_COMPRESSED:
+        body = decompress_body(body, max_message)
+    if flags & FLAG_BINARY:
+        return codec.unpackb(body)
+    return json.loads(body)
+
+
+def chunk_frame(offset: int, data) -> list:
+    """組成一個分段傳輸的 frame (header、offset、資料)，交給 sendmsg 時資料不必複製"""
+    return [pack_header(CHUNK_HEADER.size + len(data)), CHUNK_HEADER.pack(offset), data]
+
+
+def split_chunk(frame):
+    """拆開分段傳輸的 frame，回傳 (offset, 資料)"""
+    if len(frame) < CHUNK_HEADER.size:
+        raise ValueError("chunk frame too short")
+    return CHUNK_HEADER.unpack_from(frame)[0], memoryview(frame)[CHUNK_HEADER.size:]
+
+
+def choose_codec(offered) -> str:
+    """
+    依 Client 的偏好順序挑選；Server 沒有 C 加速時只要對方支援 JSON 就用 JSON
+    (大廳的訊息全在同一個事件迴圈上編解碼，純 Python 版比 C 實作的 json 慢好幾倍)
+    """
+    offered = [name for name in offered or () if name in SUPPORTED_CODECS]
+    if not codec.ACCELERATED and CODEC_JSON in offered:
+        return CODEC_JSON
+    return offered[0] if offered else CODEC_JSON
+
+
+def choose_compression(offered):
+    for name in offered or ():
+        if name in SUPPORTED_COMPRESSION:
+            return name
+    return None
+
+
+def sendmsg_all(sock: socket.socket, buffers) -> None:
+    """把多個 buffer 一次送出；有 sendmsg 時走 scatter/gather，header 與 body 都不需要複製"""
+    views = [memoryview(b).cast('B') for b in buffers if len(b)]
+    if not hasattr(sock, 'sendmsg'):
+        # Windows 沒有 sendmsg，退回逐一 sendall (一樣不做拼接複製)
+        for v in views:
+            sock.sendall(v)
+        return
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
         if sent == 0:
             raise ConnectionError("socket connection broken")
-        totalsent += sent
+        # 丟掉已送完的 buffer，最後一個送一半的用 memoryview 切片 (不複製)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+class FramedConnection:
+    """
+    包裝 socket 的串流物件：
+    - 讀取：一次 recv_into 一大塊到可重複使用的緩衝區，再從中切出緩衝區內所有完整的 frame
+    - 寫入：header 與 body 用 sendmsg 一起送出，不做 header + data 的拼接
+    其餘屬性 (close、settimeout...) 直接轉給底層 socket，可以直接取代原本的 socket 使用
+    """
+
+    def __init__(self, sock: socket.socket, bufsize: int = RECV_BUFSIZE, max_message: int = MAX_MESSAGE_LEN):
+        self.sock = sock
+        self.max_message = max_message
+        self.codec = CODEC_JSON  # 送出時使用的編碼，negotiate() 後才會改變
+        self.compress = False    # 是否壓縮超過門檻的 frame，同樣由 negotiate() 決定
+        self._next_req_id = 0
+        self._waiting = []       # 已送出、尚未收到回覆的 req_id (依送出順序)
+        self._responses = {}     # req_id -> 先到的回覆
+        self.events = deque()    # Server 主動推播的事件 (帶 "event" 欄位、沒有 req_id)
+        self._buf = bytearray(max(bufsize, HEADER.size + MAX_LEN))
+        self._start = 0  # 尚未處理的資料起點
+        self._end = 0    # 已收到的資料終點
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    # --- 讀取 ---
+
+    def buffered(self) -> int:
+        return self._end - self._start
+
+    def _fill(self, need: int) -> None:
+        """確保緩衝區內至少有 need bytes 尚未處理的資料"""
+        if self._end - self._start >= need:
+            return
+        if self._start + need > len(self._buf):
+            # 剩餘空間不夠：把尚未處理的資料搬回開頭 (只搬殘留的半個 frame)
+            remain = self._end - self._start
+            if need > len(self._buf):
+                self._buf.extend(bytes(need - len(self._buf)))
+            self._buf[:remain] = self._buf[self._start:self._end]
+            self._start, self._end = 0, remain
+        view = memoryview(self._buf)
+        try:
+            while self._end - self._start < need:
+                n = self.sock.recv_into(view[self._end:])
+                if not n:
+                    raise ConnectionError("socket connection broken while receiving")
+                self._end += n
+        finally:
+            view.release()
+
+    def _take(self, n: int) -> bytes:
+        data = bytes(self._buf[self._start:self._start + n])
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+        return data
+
+    def recv_exact(self, n: int) -> bytes:
+        self._fill(n)
+        return self._take(n)
+
+    def recv_stream(self, n: int):
+        """逐塊產生接下來的 n bytes 原始資料 (transfer = "raw")：先交出緩衝區內已收到的部分，其餘直接從 socket 讀"""
+        if self._end > self._start:
+            take = min(n, self._end - self._start)
+            yield self._take(take)
+            n -= take
+        while n > 0:
+            chunk = self.sock.recv(min(n, RECV_BUFSIZE))
+            if not chunk:
+                raise ConnectionError("socket connection broken while receiving")
+            n -= len(chunk)
+            yield chunk
+
+    def recv_frame_with_flags(self):
+        self._fill(HEADER.size)
+        flags, length = split_header(HEADER.unpack_from(self._buf, self._start)[0])
+        self._fill(HEADER.size + length)
+        self._start += HEADER.size
+        return flags, self._take(length)
+
+    def recv_frame(self) -> bytes:
+        return self.recv_frame_with_flags()[1]
+
+    def recv_message(self):
+        """收一則完整訊息：遇到 FLAG_MORE 時直接從接收緩衝區把後續 frame 接到同一個 bytearray"""
+        first_flags, body = self.recv_frame_with_flags()
+        if not first_flags & FLAG_MORE:
+            return first_flags, body
+        message = bytearray(body)
+        flags = first_flags
+        while flags & FLAG_MORE:
+            self._fill(HEADER.size)
+            flags, length = split_header(HEADER.unpack_from(self._buf, self._start)[0])
+            _check_message_size(len(message) + length, self.max_message)
+            self._fill(HEADER.size + length)
+            start = self._start + HEADER.size
+            with memoryview(self._buf) as view:
+                message += view[start:start + length]
+            self._start = start + length
+            if self._start == self._end:
+                self._start = self._end = 0
+        return first_flags & ~FLAG_MORE, message
+
+    def recv_json(self):
+        return decode_message(*self.recv_message(), max_message=self.max_message)
+
+    # --- 寫入 ---
+
+    def send_frame(self, data: bytes, flags: int = 0) -> None:
+        sendmsg_all(self.sock, [pack_header(len(data), flags), data])
+
+    def send_chunk(self, offset: int, data) -> None:
+        sendmsg_all(self.sock, chunk_frame(offset, data))
+
+    def send_json(self, obj) -> None:
+        flags, body = encode_message(obj, self.codec, self.compress)
+        sendmsg_all(self.sock, message_frames(flags, body))
+
+    # --- 請求 / 回覆配對 ---
+
+    def request(self, obj):
+        return self.pipeline([obj])[0]
+
+    def pipeline(self, requests) -> list:
+        """
+        一次送出多個請求 (各自帶 req_id，合併成一次 sendmsg)，再依 req_id 收齊回覆；
+        回傳順序與請求相同。舊版 Server 不回 req_id 時依 FIFO 對應。
+        """
+        buffers, ids = [], []
+        for req in requests:
+            self._next_req_id += 1
+            ids.append(self._next_req_id)
+            flags, body = encode_message(dict(req, req_id=self._next_req_id), self.codec, self.compress)
+            buffers.extend(message_frames(flags, body))
+        sendmsg_all(self.sock, buffers)
+        self._waiting.extend(ids)
+        while not all(i in self._responses for i in ids):
+            self._dispatch(self.recv_json())
+        return [self._responses.pop(i) for i in ids]
+
+    def _dispatch(self, msg) -> None:
+        req_id = msg.get("req_id") if isinstance(msg, dict) else None
+        if req_id is None and isinstance(msg, dict) and "event" in msg:
+            self.events.append(msg)
+            return
+        if req_id not in self._waiting:
+            if not self._waiting:
+                raise ValueError(f"unexpected message: {msg}")
+            req_id = self._waiting[0]
+        self._waiting.remove(req_id)
+        self._responses[req_id] = msg
+
+    def next_event(self, timeout=None):
+        """取出下一個推播事件；timeout 秒內沒有事件則回傳 None"""
+        old_timeout = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while not self.events:
+                self._dispatch(self.recv_json())
+        except socket.timeout:
+            return None
+        finally:
+            self.sock.settimeout(old_timeout)
+        return self.events.popleft()
+
+    def negotiate(self, codecs=PREFERRED_CODECS, compression=SUPPORTED_COMPRESSION) -> str:
+        """與大廳協商編碼與壓縮；舊版 Server 不認得 HELLO 時維持 JSON、不壓縮"""
+        self.send_json({"action": "HELLO", "codecs": list(codecs), "compress": list(compression)})
+        res = self.recv_json()
+        if res.get("status") == "SUCCESS":
+            self.codec = choose_codec([res.get("codec")])
+            self.compress = choose_compression([res.get("compress")]) is not None
+        return self.codec
+
+
+def send_frame(sock: socket.socket, data: bytes) -> None:
+    if isinstance(sock, FramedConnection):
+        return sock.send_frame(data)
+    sendmsg_all(sock, [pack_header(len(data)), data])
 
 
 def recv_exact(sock: socket.socket, n: int) -> bytes:
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
+    if isinstance(sock, FramedConnection):
+        return sock.recv_exact(n)
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        chunk = sock.recv_into(view[got:])
         if not chunk:
             raise ConnectionError("socket connection broken while receiving")
-        buf.extend(chunk)
+        got += chunk
     return bytes(buf)
 
 
 def recv_frame(sock: socket.socket) -> bytes:
-    hdr = recv_exact(sock, 4)
-    (length,) = struct.unpack('!I', hdr)
-    if length <= 0 or length > MAX_LEN:
-        raise ValueError(f"invalid incoming frame length: {length}")
+    if isinstance(sock, FramedConnection):
+        return sock.recv_frame()
+    return recv_frame_with_flags(sock)[1]
+
+
+def recv_frame_with_flags(sock: socket.socket):
+    if isinstance(sock, FramedConnection):
+        return sock.recv_frame_with_flags()
+    hdr = recv_exact(sock, HEADER.size)
+    flags, length = split_header(HEADER.unpack(hdr)[0])
     body = recv_exact(sock, length)
-    return body
+    return flags, body
+
+
+def recv_message(sock: socket.socket):
+    if isinstance(sock, FramedConnection):
+        return sock.recv_message()
+    first_flags, body = recv_frame_with_flags(sock)
+    if not first_flags & FLAG_MORE:
+        return first_flags, body
+    message = bytearray(body)
+    flags = first_flags
+    while flags & FLAG_MORE:
+        flags, chunk = recv_frame_with_flags(sock)
+        _check_message_size(len(message) + len(chunk), MAX_MESSAGE_LEN)
+        message += chunk
+    return first_flags & ~FLAG_MORE, message
 
 
 def send_json(sock: socket.socket, obj) -> None:
-    send_frame(sock, json.dumps(obj).encode('utf-8'))
+    if isinstance(sock, FramedConnection):
+        return sock.send_json(obj)
+    sendmsg_all(sock, message_frames(*encode_message(obj)))
 
 
 def recv_json(sock: socket.socket):
-    raw = recv_frame(sock)
-    return json.loads(raw.decode('utf-8'))
\ No newline at end of file
+    return decode_message(*recv_message(sock))
+
+
+# --- asyncio 版本 (大廳 Server 使用 asyncio.StreamReader / StreamWriter) ---
+
+class AsyncFramedConnection:
+    """asyncio 版的 FramedConnection：StreamReader 本身已有緩衝，這裡負責 frame 與 codec"""
+
+    def __init__(self, reader, writer, max_message: int = MAX_MESSAGE_LEN):
+        self.reader = reader
+        self.writer = writer
+        self.max_message = max_message
+        self.codec = CODEC_JSON
+        self.compress = False
+        self.write_lock = asyncio.Lock()  # 並行處理的請求共用同一個 writer，一次只讓一則訊息寫入
+
+    async def recv_frame_with_flags(self):
+        hdr = await self.reader.readexactly(HEADER.size)
+        flags, length = split_header(HEADER.unpack(hdr)[0])
+        return flags, await self.reader.readexactly(length)
+
+    async def recv_frame(self) -> bytes:
+        return (await self.recv_frame_with_flags())[1]
+
+    async def recv_message(self):
+        first_flags, body = await self.recv_frame_with_flags()
+        if not first_flags & FLAG_MORE:
+            return first_flags, body
+        message = bytearray(body)
+        flags = first_flags
+        while flags & FLAG_MORE:
+            hdr = await self.reader.readexactly(HEADER.size)
+            flags, length = split_header(HEADER.unpack(hdr)[0])
+            _check_message_size(len(message) + length, self.max_message)
+            message += await self.reader.readexactly(length)
+        return first_flags & ~FLAG_MORE, message
+
+    async def recv_json(self):
+        return decode_message(*await self.recv_message(), max_message=self.max_message)
+
+    def write_frame(self, data: bytes, flags: int = 0) -> None:
+        """只寫入 writer 的緩衝區，呼叫端需自行 await drain()"""
+        self.writer.writelines((pack_header(len(data), flags), data))
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    async def send_frame(self, data: bytes, flags: int = 0) -> None:
+        self.write_frame(data, flags)
+        await self.writer.drain()
+
+    def write_raw(self, data) -> None:
+        """原始資料直接寫入緩衝區 (transfer = "raw")，呼叫端需已持有 write_lock 並自行 await drain()"""
+        self.writer.write(data)
+
+    async def sendfile(self, file, offset: int = 0, count=None) -> None:
+        """以 loop.sendfile 送出檔案內容 (transfer = "raw")：支援時由 os.sendfile 在核心內完成，不經過 Python 的 buffer"""
+        await self.writer.drain()
+        await asyncio.get_running_loop().sendfile(self.writer.transport, file, offset, count)
+
+    def write_json(self, obj) -> None:
+        """不取鎖、只寫入緩衝區；呼叫端需已持有 write_lock"""
+        flags, body = encode_message(obj, self.codec, self.compress)
+        self.writer.writelines(message_frames(flags, body))
+
+    async def send_json(self, obj) -> None:
+        async with self.write_lock:
+            self.write_json(obj)
+            await self.writer.drain()
+
+    def get_extra_info(self, name):
+        return self.writer.get_extra_info(name)
+
+    def close(self) -> None:
+        self.writer.close()
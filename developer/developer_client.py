@@ -6,6 +6,8 @@ import zipfile
 import io
 import time
 import shutil
+import tempfile
+import hashlib
 
 # --- 路徑設定 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,9 +16,11 @@ sys.path.append(current_dir)
 sys.path.append(parent_dir)
 
 # --- Import ---
-from common.protocol import send_json, recv_json, send_frame
+from common.protocol import send_json, recv_json, FramedConnection, CHUNK_SIZE, TRANSFER_CHUNKED
 from common.constant import SERVER_PORT, SERVER_IP
 
+SPOOL_MAX = 4 * 1024 * 1024  # 打包上傳檔超過此大小就改存到暫存檔
+
 class DevClient:
     def __init__(self):
         self.sock = None
@@ -26,8 +30,10 @@ class DevClient:
     def connect(self):
         """連線到 Server"""
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((SERVER_IP, SERVER_PORT))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((SERVER_IP, SERVER_PORT))
+            self.sock = FramedConnection(sock)
+            self.sock.negotiate()  # 協商精簡二進位編碼，舊版 Server 則維持 JSON
             self.is_connected = True
             print(f"[連線] 成功連線到 {SERVER_IP}:{SERVER_PORT}")
         except Exception as e:
@@ -175,33 +181,84 @@ class DevClient:
             print(recv_json(self.sock).get('message'))
 
     def _send_zip_payload(self, source_dir, g_name, g_ver, g_desc, folder_name, action, max_players=2):
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(source_dir):
-                for file in files:
-                    zf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), source_dir))
-        
-        zip_data = memory_file.getvalue()
-        
-        payload = {
-            "action": action, 
-            "game_name": g_name, 
-            "version": g_ver,
-            "description": g_desc, 
-            "filename": f"{folder_name}.zip", 
-            "size": len(zip_data),
-            "max_players": max_players 
-        }
-        
-        send_json(self.sock, payload)
-        
+        # 小的專案留在記憶體，超過 SPOOL_MAX 自動改存暫存檔，大型遊戲素材不會整包佔住 RAM
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX) as package:
+            with zipfile.ZipFile(package, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for root, _, files in os.walk(source_dir):
+                    for file in files:
+                        zf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), source_dir))
+            package.seek(0, io.SEEK_END)
+            size = package.tell()
+            package.seek(0)
+
+            payload = {
+                "action": action, 
+                "game_name": g_name, 
+                "version": g_ver,
+                "description": g_desc, 
+                "filename": f"{folder_name}.zip", 
+                "size": size,
+                "max_players": max_players,
+                "transfer": TRANSFER_CHUNKED
+            }
+            
+            send_json(self.sock, payload)
+            
+            res = recv_json(self.sock)
+            if res.get('status') == 'READY':
+                digest = self._send_chunks(package, size)
+                send_json(self.sock, {"sha256": digest})
+                final_res = recv_json(self.sock)
+                print(final_res.get('message'))
+                if final_res.get('status') == 'SUCCESS' and 'job_id' in final_res:
+                    self.wait_upload_job(final_res['job_id'])
+            else:
+                print(f"[失敗] 伺服器拒絕上傳: {res.get('message')}")
+
+    def wait_upload_job(self, job_id):
+        """檔案已送達，伺服器在背景解壓與打包；輪詢 UPLOAD_STATUS 直到完成 (Ctrl+C 可先離開，稍後再查)"""
+        last_state = None
+        try:
+            while True:
+                send_json(self.sock, {"action": "UPLOAD_STATUS", "job_id": job_id})
+                res = recv_json(self.sock)
+                job = res.get('job')
+                if not job:
+                    print(f"[錯誤] {res.get('message')}")
+                    return
+                if job['state'] in ('done', 'failed'):
+                    print(("[完成] " if job['state'] == 'done' else "[失敗] ") + job['message'])
+                    return
+                if job['state'] != last_state:
+                    print(f"[處理中] 工作 #{job_id}: {job['state']}")
+                    last_state = job['state']
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("\n已停止等待，可從選單「查看上傳進度」確認結果。")
+
+    def view_upload_jobs(self):
+        send_json(self.sock, {"action": "UPLOAD_STATUS"})
         res = recv_json(self.sock)
-        if res.get('status') == 'READY':
-            send_frame(self.sock, zip_data)
-            final_res = recv_json(self.sock)
-            print(final_res.get('message'))
-        else:
-            print(f"[失敗] 伺服器拒絕上傳: {res.get('message')}")
+        print("\n=== 上傳進度 ===")
+        jobs = res.get('jobs', [])
+        if not jobs: print("目前沒有上傳紀錄。")
+        for job in jobs:
+            print(f"#{job['job_id']} {job['action']} {job['game_name']}: {job['state']} {job['message']}")
+
+    def _send_chunks(self, f, size):
+        """以固定大小的分段 (附 offset) 串流送出檔案，邊送邊算 sha256"""
+        digest = hashlib.sha256()
+        offset = 0
+        while offset < size:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise IOError("打包檔案在傳送途中被截斷")
+            self.sock.send_chunk(offset, chunk)
+            digest.update(chunk)
+            offset += len(chunk)
+            print(f"\r[上傳] {offset * 100 // size}% ({offset}/{size} bytes)", end="", flush=True)
+        print()
+        return digest.hexdigest()
 
     def view_my_games(self):
         send_json(self.sock, {"action": "LIST_MY_GAMES"})
@@ -229,14 +286,16 @@ class DevClient:
                 print("3. 更新遊戲版本")
                 print("4. 下架遊戲")
                 print("5. 建立新專案 (Template)")
-                print("6. 登出")
+                print("6. 查看上傳進度")
+                print("7. 登出")
                 c = input("請選擇: ").strip()
                 if c == '1':self.view_my_games()
                 elif c == '2': self.upload_game()
                 elif c == '3': self.update_game_flow()
                 elif c == '4': self.remove_game_flow()
                 elif c == '5': self.create_new_project()
-                elif c == '6': self.user_data = None; print("已登出")
+                elif c == '6': self.view_upload_jobs()
+                elif c == '7': self.user_data = None; print("已登出")
 
 if __name__ == "__main__":
     DevClient().start()
\ No newline at end of file
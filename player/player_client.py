@@ -5,121 +5,764 @@ import os
 import subprocess
 import time
 import zipfile
-import io
 import json
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 路徑設定 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from common.protocol import send_json, recv_json, recv_frame
+from common.protocol import FramedConnection, TRANSFER_RAW
 from common.constant import SERVER_PORT, SERVER_IP
 
+PAGE_SIZE = 10  # 商城與評論每頁筆數
+STORE_SORTS = [("name", "名稱"), ("rating", "評分"), ("updated", "最近更新")]
+# 斷線重連後可以安全重送的請求 (重送不會重複建立房間、重複評價)
+RETRY_SAFE_ACTIONS = {"LIST_GAMES", "SEARCH_GAMES", "GET_REVIEWS", "LIST_ROOMS", "CHECK_ROOM", "DOWNLOAD", "SYNC_GAME"}
+MANIFEST_NAME = ".manifest.json"  # 記錄已安裝的版本與各檔案 sha256，差異更新時送給 Server 比對
+DOWNLOAD_RETRIES = 5  # DOWNLOAD 斷線後續傳的次數上限
+EXTRACT_WORKERS = min(4, os.cpu_count() or 1)  # 解壓遊戲 zip 的執行緒數
+# 同一台機器所有帳號共用的檔案快取：依 sha256 存放，各帳號的安裝目錄以 hard link 指向這裡
+BLOB_DIR = os.path.join(current_dir, "downloads", ".blobs")
+PREFETCH_RATE = 4 * 1024 * 1024              # 背景預抓的頻寬上限 (bytes/s)，不跟遊戲與大廳搶頻寬
+PREFETCH_DISK_BUDGET = 2 * 1024 * 1024 * 1024  # blob 快取超過此大小就不再預抓
+PREFETCH_WAIT = 30  # 安裝時遇到同一款遊戲正在預抓，最多等幾秒
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def blob_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+
+def seal_blob(path):
+    """
+    blob 設為唯讀：各帳號安裝目錄中的檔案是 blob 的 hard link，不能讓任何一邊原地改寫共用的內容
+    Windows 上唯讀的 hard link 無法被 rename 取代或刪除 (更新時要換掉它)，只在 POSIX 上設定
+    """
+    if os.name == "posix":
+        os.chmod(path, 0o444)
+
+
+def verified_blob(sha256, size):
+    """blob 存在且大小與 sha256 都正確時回傳路徑；內容不符 (被改寫過) 的 blob 直接刪除並回傳 None"""
+    path = blob_path(sha256)
+    if not os.path.isfile(path):
+        return None
+    if os.path.getsize(path) == size and file_sha256(path) == sha256:
+        return path
+    os.remove(path)
+    return None
+
+
+def link_or_copy(src, dst):
+    """以 hard link 取代複製；不支援 hard link 的檔案系統退回一般複製"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def receive_verified(conn, target, meta, on_chunk=None):
+    """接收 SYNC_GAME 回覆後的一個檔案：先寫暫存檔、校驗 sha256 後才取代 target"""
+    tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.part"
+    digest = hashlib.sha256()
+    received = 0
+    with open(tmp, 'wb') as f:
+        while received < meta['size']:
+            chunk = conn.recv_frame()
+            f.write(chunk)
+            digest.update(chunk)
+            received += len(chunk)
+            if on_chunk:
+                on_chunk(len(chunk))
+    if digest.hexdigest() != meta['sha256']:
+        os.remove(tmp)
+        raise ValueError(f"檔案校驗失敗: {meta['path']}")
+    os.replace(tmp, target)
+
+
+def blob_cache_size():
+    total = 0
+    for root, _, names in os.walk(BLOB_DIR):
+        for name in names:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class Prefetcher:
+    """
+    背景預先下載：在獨立的執行緒與連線上把商城 / 房間列表上看到的遊戲、玩過的遊戲檔案抓進 blob 快取
+    之後 ensure_latest_version 幾乎都能直接從快取 link，加入房間時不必等下載
+    - 頻寬：每秒最多 PREFETCH_RATE bytes (讀慢一點，TCP 就會讓 Server 送慢一點)；前景正在等的遊戲則全速下載
+    - 磁碟：blob 快取總大小超過 PREFETCH_DISK_BUDGET 時不再預抓
+    """
+
+    def __init__(self):
+        self.queue = deque()     # 待預抓的 game_id，越前面越優先
+        self.current = None      # 正在預抓的 game_id
+        self.rush = None         # 前景在等的 game_id，這一次預抓不限速
+        self.cond = threading.Condition()
+        self.conn = None
+        self.cache_size = 0      # blob 快取目前的大小 (每次預抓前重新計算，前景安裝也會放檔案進去)
+        self.closed = False
+        threading.Thread(target=self._run, name="prefetch", daemon=True).start()
+
+    def hint(self, game_ids, urgent=False):
+        """加入預抓清單；urgent (房間列表上的遊戲) 排到最前面"""
+        with self.cond:
+            for game_id in game_ids:
+                if game_id == self.current:
+                    continue
+                if game_id in self.queue:
+                    if not urgent:
+                        continue
+                    self.queue.remove(game_id)
+                if urgent:
+                    self.queue.appendleft(game_id)
+                else:
+                    self.queue.append(game_id)
+            self.cond.notify()
+
+    def wait_for(self, game_id, timeout=PREFETCH_WAIT):
+        """
+        若 game_id 正在預抓就等它完成 (快取補齊後再安裝)，不重複下載同一批檔案
+        前景在等就不再限速，否則玩家要等的時間會比直接下載還久
+        """
+        with self.cond:
+            if game_id in self.queue:
+                self.queue.remove(game_id)
+            if self.current == game_id:
+                self.rush = game_id
+            self.cond.wait_for(lambda: self.current != game_id, timeout)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue or self.closed)
+                if self.closed:
+                    break
+                self.current = self.queue.popleft()
+            try:
+                self._prefetch(self.current)
+            except (ConnectionError, OSError, ValueError):
+                # 預抓只是加速，失敗就丟掉這條連線，下次有提示時再試
+                self._disconnect()
+            except Exception as e:
+                # 非預期的回覆 (例如缺欄位的 FAIL) 也不能讓執行緒結束，否則之後再也不會預抓
+                print(f"\n[預抓] {self.current} 失敗: {e!r}")
+                self._disconnect()
+            finally:
+                # 不論成功與否都通知 wait_for，前景改用一般下載補齊
+                with self.cond:
+                    self.current = self.rush = None
+                    self.cond.notify_all()
+        self._disconnect()
+
+    def _disconnect(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+
+    def _prefetch(self, game_id):
+        if self.conn is None:
+            self.conn = FramedConnection(socket.create_connection((SERVER_IP, SERVER_PORT)))
+            self.conn.negotiate()
+        self.cache_size = blob_cache_size()
+
+        res = self.conn.request({"action": "SYNC_GAME", "game_id": game_id, "manifest": {}, "dry_run": True})
+        if res['status'] != 'SUCCESS':
+            return
+        if not res.get('dry_run'):
+            raise ValueError("Server 不支援 dry_run")  # 檔案內容已經在路上，斷線重來
+        missing = {f['path'] for f in res['files'] if not os.path.isfile(blob_path(f['sha256']))}
+        need = sum(f['size'] for f in res['files'] if f['path'] in missing)
+        if not missing or self.cache_size + need > PREFETCH_DISK_BUDGET:
+            return
+
+        # 快取已有的檔案寫進 manifest，Server 只會送缺少的部分
+        have = {f['path']: f['sha256'] for f in res['files'] if f['path'] not in missing}
+        res = self.conn.request({"action": "SYNC_GAME", "game_id": game_id, "manifest": have})
+        if res['status'] != 'SUCCESS':
+            return
+        started, sent = time.monotonic(), 0
+
+        def throttle(n):
+            nonlocal sent
+            sent += n
+            if self.rush == game_id:
+                return
+            delay = sent / PREFETCH_RATE - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        for f in res['files']:
+            blob = blob_path(f['sha256'])
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            receive_verified(self.conn, blob, f, throttle)
+            seal_blob(blob)
+            self.cache_size += f['size']
+
+
 class PlayerClient:
     def __init__(self):
         self.sock = None
         self.user_data = None
+        self.token = None            # LOGIN 取得的 session token，斷線後用 RESUME 恢復登入
+        self.catalog_pages = {}      # (排序, 作者, 游標) -> (games, 下一頁游標)
+        self.catalog_version = None  # 這些分頁對應的目錄版本，沒變就不必重新下載
+        self.prefetcher = None       # 登入後才啟動背景預抓
+
+    def open_connection(self):
+        sock = socket.create_connection((SERVER_IP, SERVER_PORT))
+        self.sock = FramedConnection(sock)
+        self.sock.negotiate()  # 協商精簡二進位編碼，舊版 Server 則維持 JSON
 
     def connect(self):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((SERVER_IP, SERVER_PORT))
+            self.open_connection()
             print("[系統] 已連線到大廳")
         except:
             print("[錯誤] 無法連線到 Server")
             sys.exit(1)
+
+    def reconnect(self):
+        """重新連線並以 token 恢復登入狀態與房間訂閱；回傳 RESUME 的回覆，無法恢復登入時回傳 None"""
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        try:
+            self.open_connection()
+        except OSError:
+            print("[錯誤] 無法重新連線到 Server")
+            sys.exit(1)
+        if not self.user_data:
+            return None
+        if not self.token:
+            print("[系統] 無法恢復登入狀態，請重新登入")
+            self.drop_login()
+            return None
+        res = self.sock.request({"action": "RESUME", "token": self.token, "subscribe": True})
+        if res['status'] != 'SUCCESS':
+            print(f"[系統] {res.get('message')}")
+            self.drop_login()
+            return None
+        print("[系統] 已重新連線")
+        return res
+
+    def drop_login(self):
+        """清掉本地的登入狀態 (登出或無法 RESUME 時)，主選單會回到登入畫面"""
+        self.user_data = self.token = None
+        self.catalog_pages = {}
+        self.catalog_version = None
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def request(self, req):
+        """送出請求；連線中斷時自動重連，可安全重送的請求再送一次"""
+        try:
+            return self.sock.request(req)
+        except (ConnectionError, OSError):
+            print("\n[系統] 與大廳的連線中斷，正在重新連線...")
+            logged_in = self.user_data is not None
+            if self.reconnect() is None and logged_in:
+                # 新連線沒有登入身分，重送只會得到「請先登入」，讓各選單直接返回主選單
+                return {"status": "FAIL", "message": "登入已失效，請重新登入"}
+        if req.get("action") in RETRY_SAFE_ACTIONS:
+            return self.sock.request(req)
+        return {"status": "FAIL", "message": "連線中斷，請再試一次"}
     
     def register(self):
         u = input("帳號: ")
         p = input("密碼: ")
-        send_json(self.sock, {"action": "REGISTER", "username": u, "password": p})
-        print("Server回覆:", recv_json(self.sock).get('message'))
+        res = self.request({"action": "REGISTER", "username": u, "password": p})
+        print("Server回覆:", res.get('message'))
 
     def login(self):
         u = input("帳號: ")
         p = input("密碼: ")
-        send_json(self.sock, {"action": "LOGIN", "username": u, "password": p})
-        res = recv_json(self.sock)
+        res = self.request({"action": "LOGIN", "username": u, "password": p})
         if res['status'] == 'SUCCESS':
             print("登入成功！")
             self.user_data = res['user']
+            self.token = res.get('token')
+            self.start_prefetch()
         else:
             print(f"登入失敗: {res.get('message', '未知錯誤')}")
 
     # === 核心功能：版本管理與自動下載 (RQU-5 P2, P3) ===
 
-    def get_local_version(self, game_id):
-        """讀取本地已下載遊戲的版本號 (由 game_config.json 讀取)"""
-        path = os.path.join(parent_dir, "downloads", self.user_data['username'], game_id, "game_config.json")
+    def start_prefetch(self):
+        """登入後啟動背景預抓，先把玩過 (已安裝) 的遊戲更新進快取"""
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher()
+        user_dir = os.path.join(current_dir, "downloads", self.user_data['username'])
+        if os.path.isdir(user_dir):
+            for name in os.listdir(user_dir):
+                # 上次中斷的安裝：.old-{game_id} 或 .staging-{game_id}-{亂數}
+                if name.startswith(".old-"):
+                    game_id = name[len(".old-"):]
+                elif name.startswith(".staging-"):
+                    game_id = name[len(".staging-"):].rpartition("-")[0]
+                else:
+                    continue
+                try:
+                    self.restore_install(game_id)
+                except OSError:
+                    pass
+            self.prefetcher.hint(sorted(name for name in os.listdir(user_dir) if not name.startswith(".")))
+
+    def prefetch(self, game_ids, urgent=False):
+        if self.prefetcher:
+            self.prefetcher.hint(game_ids, urgent)
+
+    def game_dir(self, game_id):
+        """玩家的遊戲安裝位置：downloads/{username}/{game_id}"""
+        return os.path.join(current_dir, "downloads", self.user_data['username'], game_id)
+
+    def old_install_dir(self, game_id):
+        """swap_install 換上新版本前，舊安裝暫時改名的位置"""
+        return os.path.join(os.path.dirname(self.game_dir(game_id)), f".old-{game_id}")
+
+    def restore_install(self, game_id, keep=None):
+        """
+        收拾中斷的安裝：swap_install 的兩次 rename 之間中斷時，安裝目錄不存在、舊版本還留在 .old-{game_id}，把它改回來；
+        當掉時留下的 .staging-{game_id}-* 也一併刪除 (keep 為目前正在使用的 staging)
+        """
+        game_dir, old_dir = self.game_dir(game_id), self.old_install_dir(game_id)
+        if not os.path.exists(game_dir) and os.path.isdir(old_dir):
+            os.rename(old_dir, game_dir)
+        parent, prefix = os.path.dirname(game_dir), f".staging-{game_id}-"
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            # mkdtemp 的亂數後綴不含 "-"，game_id 為 "a" 時不會誤刪 "a-b" 的 staging
+            if name.startswith(prefix) and "-" not in name[len(prefix):]:
+                path = os.path.join(parent, name)
+                if keep is None or not os.path.samefile(path, keep):
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def load_local_manifest(self, game_id):
+        """讀取本地 manifest ({"version": ..., "files": {路徑: {"sha256", "size"}}})；沒有時回傳 None"""
+        try:
+            self.restore_install(game_id)
+        except OSError:
+            pass  # 還原不了就當作沒有安裝，照常重新下載
+        path = os.path.join(self.game_dir(game_id), MANIFEST_NAME)
         if not os.path.exists(path):
             return None
         try:
             with open(path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                return config.get("version")
-        except:
+                return json.load(f)
+        except (OSError, ValueError):
             return None
 
-    def ensure_latest_version(self, game_id, server_version):
-        """強制檢查版本：若本地版本不符或未安裝，則自動觸發下載 (符合 P2)"""
+    def save_local_manifest(self, game_dir, version, files):
+        # 先寫新檔再取代：staging 中的舊 manifest 可能是與目前安裝共用的 hard link，不能原地覆寫
+        path = os.path.join(game_dir, MANIFEST_NAME)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({"version": version, "files": files}, f)
+        os.replace(path + ".tmp", path)
+
+    def scan_local_files(self, game_dir):
+        """計算資料夾內現有檔案的 sha256 (沒有 manifest 的舊安裝、下載完整 zip 後使用)"""
+        files = {}
+        for root, dirs, names in os.walk(game_dir):
+            dirs[:] = [d for d in dirs if d != "__pycache__"]
+            for name in names:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, game_dir).replace(os.sep, "/")
+                if rel == MANIFEST_NAME:
+                    continue
+                files[rel] = {"sha256": file_sha256(path), "size": os.path.getsize(path)}
+        return files
+
+    def get_local_version(self, game_id):
+        """讀取本地已下載遊戲的版本號 (下載 / 更新時寫入的 manifest)"""
+        manifest = self.load_local_manifest(game_id)
+        return manifest.get("version") if manifest else None
+
+    def ensure_latest_version(self, game_id, server_version, room_id=None):
+        """強制檢查版本：若本地版本不符或未安裝，則自動觸發下載 (符合 P2)；已安裝時只下載有變動的檔案"""
         local_ver = self.get_local_version(game_id)
+        if local_ver != server_version and self.prefetcher:
+            self.prefetcher.wait_for(game_id)
         
-        if local_ver is None:
+        if local_ver is None and not os.path.isdir(self.game_dir(game_id)):
             print(f"[系統] 偵測到未安裝 {game_id}，開始自動下載...")
-            return self.download_game(game_id)
+            return self.sync_game(game_id, server_version, room_id)
         elif local_ver != server_version:
             print(f"[系統] 偵測到新版本 (本地:{local_ver} -> 雲端:{server_version})，正在強制更新...")
-            return self.download_game(game_id)
+            return self.sync_game(game_id, server_version, room_id)
         else:
             print(f"[系統] 檔案版本校驗通過 (v{local_ver})")
-            return os.path.join(parent_dir, "downloads", self.user_data['username'], game_id)
+            return self.game_dir(game_id)
+
+    def sync_game(self, game_id, version, room_id=None):
+        """以 SYNC_GAME 差異更新；Server 不支援 (舊資料) 時改為下載完整 zip"""
+        game_dir = self.game_dir(game_id)
+        manifest = self.load_local_manifest(game_id)
+        if manifest:
+            # 只信任大小仍相符的項目，被刪掉或改過大小的檔案會重新下載
+            local = {path: meta for path, meta in manifest.get("files", {}).items()
+                     if os.path.isfile(os.path.join(game_dir, path)) and os.path.getsize(os.path.join(game_dir, path)) == meta['size']}
+        elif os.path.isdir(game_dir):
+            local = self.scan_local_files(game_dir)
+        else:
+            local = {}
 
-    def download_game(self, game_id):
-        """從伺服器下載 ZIP 並解壓到玩家隔離區"""
-        send_json(self.sock, {"action": "DOWNLOAD", "game_id": game_id})
-        res = recv_json(self.sock)
-        
-        if res['status'] == 'SUCCESS':
-            file_size = res['size']
-            file_data = bytearray()
-            while len(file_data) < file_size:
-                chunk = recv_frame(self.sock)
-                file_data.extend(chunk)
-            
-            # 存放到 downloads/{username}/{game_id}
-            download_dir = os.path.join(current_dir, "downloads", self.user_data['username'], game_id)
-            if not os.path.exists(download_dir):
-                os.makedirs(download_dir)
-            
-            with zipfile.ZipFile(io.BytesIO(file_data)) as zf:
-                zf.extractall(download_dir)
-            print(f"[系統] {game_id} 下載/更新完成。")
-            return download_dir
+        # 先以 dry_run 取得差異清單，本機 blob 快取已有的檔案直接 link，剩下的才從 Server 下載
+        req = {"action": "SYNC_GAME", "game_id": game_id, "manifest": {path: meta['sha256'] for path, meta in local.items()}}
+        if room_id:
+            req["room_id"] = room_id
+        res = self.request(dict(req, dry_run=True))
+        if res['status'] != 'SUCCESS':
+            return self.download_game(game_id, version)
+
+        # 在 staging 上套用變更，全部成功才換上；中途失敗時原本的安裝不受影響
+        staging = self.new_staging_dir(game_id)
+        cached = []
+        try:
+            self.link_install(game_id, staging)
+            if res.get('dry_run'):  # 舊版 Server 不認得 dry_run，回覆後已經直接送出檔案內容
+                cached = self.fetch_from_blobs(staging, res['files'])
+                for f in cached:
+                    local[f['path']] = {"sha256": f['sha256'], "size": f['size']}
+                if len(cached) == len(res['files']):
+                    res = dict(res, files=[], size=0)  # 全部由快取補上，不必再連線下載
+                else:
+                    req["manifest"] = {path: meta['sha256'] for path, meta in local.items()}
+                    res = self.request(req)
+                    if res['status'] != 'SUCCESS':
+                        raise ValueError(res.get('message'))
+            for f in res['files']:
+                self.receive_synced_file(staging, f)
+                local[f['path']] = {"sha256": f['sha256'], "size": f['size']}
+            for path in res['delete']:
+                target = self.safe_path(staging, path)
+                if os.path.isfile(target):
+                    os.remove(target)
+                local.pop(path, None)
+            self.save_local_manifest(staging, res['version'], local)
+            self.swap_install(game_id, staging)
+            self.store_blobs(game_dir, local)
+        except (ValueError, OSError) as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            print(f"[錯誤] 更新失敗: {e}")
+            # 回覆後面可能還有沒讀完的檔案內容，重新連線讓連線回到請求 / 回覆的邊界
+            self.reconnect()
+            return None
+        print(f"[系統] {game_id} 已更新至 v{res['version']} (下載 {len(res['files'])} 個檔案，{res['size']} bytes；"
+              f"本機快取 {len(cached)} 個檔案)")
+        return game_dir
+
+    @staticmethod
+    def safe_path(game_dir, path):
+        target = os.path.normpath(os.path.join(game_dir, *path.split("/")))
+        if os.path.commonpath([os.path.abspath(game_dir), os.path.abspath(target)]) != os.path.abspath(game_dir):
+            raise ValueError(f"不合法的檔案路徑: {path}")
+        return target
+
+    def receive_synced_file(self, game_dir, meta):
+        """接收 SYNC_GAME 回覆後的一個檔案，放進 game_dir 中對應的位置"""
+        target = self.safe_path(game_dir, meta['path'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        receive_verified(self.sock, target, meta)
+
+    def new_staging_dir(self, game_id):
+        """在安裝目錄旁建立暫存目錄 (同一個檔案系統，之後才能用 rename 換上)"""
+        parent = os.path.dirname(self.game_dir(game_id))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".staging-{game_id}-", dir=parent)
+        os.chmod(staging, 0o755)  # mkdtemp 建立的是 0700，換上後就是安裝目錄本身，權限要與一般目錄相同
+        return staging
+
+    def swap_install(self, game_id, staging):
+        """
+        把準備好的 staging 換成正式安裝目錄：舊目錄先改名為 .old-{game_id}，再把 staging 改名上去
+        兩次 rename 之間中斷 (當機、斷電) 時由 restore_install 把舊目錄改回來，換上失敗時也立即改回
+        """
+        game_dir = self.game_dir(game_id)
+        old_dir = self.old_install_dir(game_id)
+        self.restore_install(game_id, keep=staging)  # 上次中斷留下的舊安裝要先改回來，不能當成垃圾刪掉
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(game_dir):
+            os.rename(game_dir, old_dir)
+        try:
+            os.rename(staging, game_dir)
+        except OSError:
+            if os.path.exists(old_dir):
+                os.rename(old_dir, game_dir)
+            raise
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return game_dir
+
+    def link_install(self, game_id, staging):
+        """目前的安裝以 hard link 複製到 staging (不複製資料)；差異更新只會取代或刪除 staging 中的連結"""
+        game_dir = self.game_dir(game_id)
+        if os.path.isdir(game_dir):
+            shutil.copytree(game_dir, staging, copy_function=link_or_copy, dirs_exist_ok=True)
+
+    def extract_package(self, zip_path, dest):
+        """把 zip 解壓到 dest：檔案依大小平均分給多個執行緒，各自開一個 ZipFile 串流解壓 (zlib 解壓時會釋放 GIL)"""
+        with zipfile.ZipFile(zip_path) as zf:
+            members = zf.infolist()
+        groups = [[] for _ in range(min(EXTRACT_WORKERS, len(members)) or 1)]
+        loads = [0] * len(groups)
+        for member in sorted(members, key=lambda m: m.file_size, reverse=True):
+            target = self.safe_path(dest, member.filename)
+            # 資料夾先建好，避免多個執行緒同時建立同一層
+            os.makedirs(target if member.is_dir() else os.path.dirname(target), exist_ok=True)
+            if not member.is_dir():
+                i = loads.index(min(loads))
+                groups[i].append(member)
+                loads[i] += member.file_size
+
+        def extract(group):
+            with zipfile.ZipFile(zip_path) as zf:
+                for member in group:
+                    zf.extract(member, dest)
+
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            list(pool.map(extract, groups))
+
+    def fetch_from_blobs(self, staging, files):
+        """從本機 blob 快取把檔案 link 進 staging，回傳補上的項目 (不必經過網路)"""
+        found = []
+        for f in files:
+            blob = verified_blob(f['sha256'], f['size'])
+            if blob is None:
+                continue
+            target = self.safe_path(staging, f['path'])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_or_copy(blob, target + ".part")
+            os.replace(target + ".part", target)
+            found.append(f)
+        return found
+
+    def store_blobs(self, game_dir, files):
+        """
+        安裝完成後把檔案登記到 blob 快取，同一台機器的其他帳號就不必再下載
+        快取裡已經有的內容則把安裝目錄中的檔案換成指向快取的 hard link，同一份內容在磁碟上只存一份
+        """
+        for path, meta in files.items():
+            source = self.safe_path(game_dir, path)
+            blob = blob_path(meta['sha256'])
+            try:
+                if os.path.exists(blob) and not os.path.samefile(source, blob):
+                    # 先校驗再 link，被改寫過的 blob 會被刪掉，改由這次剛校驗過的安裝檔重新登記
+                    if verified_blob(meta['sha256'], meta['size']):
+                        os.link(blob, source + ".part")
+                        os.replace(source + ".part", source)
+                        continue
+                if not os.path.exists(blob):
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    # 多個 Client 可能同時登記同一個 blob，先放暫存名稱再 rename
+                    tmp = f"{blob}.{os.getpid()}.tmp"
+                    link_or_copy(source, tmp)
+                    seal_blob(tmp)
+                    os.replace(tmp, blob)
+                else:
+                    seal_blob(blob)  # 舊版登記、還可寫入的 blob
+            except OSError:
+                continue  # 快取只是加速，失敗時安裝本身仍然完整
+
+    def download_game(self, game_id, version=None):
+        """
+        從伺服器下載 ZIP 並解壓到玩家隔離區
+        下載中的檔案寫在 downloads/{username}/.partial/，斷線後重新連線並從已收到的 offset 續傳，收完以 sha256 校驗
+        """
+        partial_dir = os.path.join(current_dir, "downloads", self.user_data['username'], ".partial")
+        part_path = os.path.join(partial_dir, f"{game_id}.zip.part")
+        meta_path = part_path + ".json"  # 記錄這份 .part 屬於哪個檔案 (sha256)，版本更新後不會接錯
+        os.makedirs(partial_dir, exist_ok=True)
+
+        for attempt in range(DOWNLOAD_RETRIES):
+            req = {"action": "DOWNLOAD", "game_id": game_id, "transfer": TRANSFER_RAW}
+            if os.path.exists(part_path) and os.path.exists(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    req["if_sha256"] = json.load(f).get("sha256")
+                req["offset"] = os.path.getsize(part_path)
+            res = self.request(req)
+            if res['status'] != 'SUCCESS':
+                # 續傳被拒 (例如 offset 超出範圍) 時丟掉暫存檔從頭下載，避免之後每次都卡在同一份 .part
+                for path in (part_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                if "offset" in req:
+                    continue
+                print(f"[錯誤] 下載失敗: {res.get('message')}")
+                return None
+            offset = res.get('offset', 0)  # 舊版 Server 不支援續傳，一律從頭送
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({"sha256": res.get('sha256')}, f)
+            if offset:
+                print(f"[系統] 從 {offset}/{res['size']} bytes 繼續下載...")
+            try:
+                with open(part_path, 'ab') as f:
+                    f.truncate(offset)
+                    remaining = res['size'] - offset
+                    if res.get('transfer') == TRANSFER_RAW:
+                        for chunk in self.sock.recv_stream(remaining):
+                            f.write(chunk)
+                    else:
+                        # 舊版 Server：檔案切成 frame 送來
+                        while remaining > 0:
+                            chunk = self.sock.recv_frame()
+                            f.write(chunk)
+                            remaining -= len(chunk)
+                break
+            except (ConnectionError, OSError):
+                print("\n[系統] 下載中斷，重新連線後續傳...")
+                self.reconnect()
         else:
-            print(f"[錯誤] 下載失敗: {res.get('message')}")
+            print("[錯誤] 下載失敗: 連線多次中斷，請稍後再試")
+            return None
+
+        os.remove(meta_path)
+        if res.get('sha256') and file_sha256(part_path) != res['sha256']:
+            os.remove(part_path)
+            print("[錯誤] 下載的檔案校驗失敗，請重新下載")
+            return None
+
+        # 解壓到 staging 再整個換上 downloads/{username}/{game_id}，解壓失敗不會留下新舊混雜的安裝
+        staging = self.new_staging_dir(game_id)
+        try:
+            self.extract_package(part_path, staging)
+            files = self.scan_local_files(staging)
+            if version:
+                self.save_local_manifest(staging, version, files)
+            download_dir = self.swap_install(game_id, staging)
+            self.store_blobs(download_dir, files)
+        except (ValueError, OSError, zipfile.BadZipFile) as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            print(f"[錯誤] 安裝失敗: {e}")
             return None
+        finally:
+            os.remove(part_path)
+        print(f"[系統] {game_id} 下載/更新完成。")
+        return download_dir
 
     # === 商城與評價功能 (RQU-5 P1, RQU-6 P4) ===
 
+    def fetch_store_page(self, sort, author, after):
+        """取得商城的一頁；手上有同一頁時帶上 if_version，目錄沒變時 Server 只回 NOT_MODIFIED"""
+        key = (sort, author, tuple(after) if after else None)
+        cached = self.catalog_pages.get(key)
+        req = {"action": "LIST_GAMES", "sort": sort, "after": after, "limit": PAGE_SIZE}
+        if author:
+            req["author"] = author
+        if cached:
+            req["if_version"] = self.catalog_version
+        res = self.request(req)
+        if res['status'] == 'NOT_MODIFIED':
+            return cached
+        if res['status'] != 'SUCCESS':
+            print(f"[錯誤] {res.get('message')}")
+            return None
+        if res.get('version') != self.catalog_version:
+            self.catalog_pages = {}
+            self.catalog_version = res.get('version')
+        page = self.catalog_pages[key] = (res.get('games', []), res.get('next'))
+        return page
+
     def list_games(self):
-        """顯示遊戲商城清單"""
-        send_json(self.sock, {"action": "LIST_GAMES"})
-        res = recv_json(self.sock)
-        if res['status'] == 'SUCCESS':
-            games = res.get('games', [])
-            print("\n=== 遊戲商城 (Store) ===")
-            if not games: print("目前商城沒有上架遊戲。"); return
-            
+        """顯示遊戲商城清單 (一次只取一頁)"""
+        sort_idx, author = 0, None
+        cursors = [None]  # 每一頁的起始游標，用來回上一頁
+        while True:
+            sort, sort_label = STORE_SORTS[sort_idx]
+            page = self.fetch_store_page(sort, author, cursors[-1])
+            if page is None: return
+            games, next_cursor = page
+            self.prefetch([g['name'] for g in games])
+
+            print(f"\n=== 遊戲商城 (Store) 第 {len(cursors)} 頁 | 排序: {sort_label}" + (f" | 作者: {author}" if author else "") + " ===")
+            if not games: print("目前商城沒有符合的遊戲。")
             for i, g in enumerate(games):
                 avg_rating = f"{g['avg_rating']:.1f}" if g.get('avg_rating') else "尚無"
                 print(f"{i+1}. {g['name']} [★ {avg_rating}]")
 
-            choice = input("\n請輸入編號查看詳情 (輸入 q 返回): ").strip()
-            if choice.lower() == 'q': return
-            try:
-                self.show_game_detail(games[int(choice)-1])
-            except: print("無效選擇")
+            print("\n[編號] 查看詳情 [n] 下一頁 [p] 上一頁 [s] 切換排序 [a] 依作者篩選 [f] 搜尋 [q] 返回")
+            choice = input("請輸入選擇: ").strip().lower()
+            if choice == 'q': return
+            elif choice == 'f':
+                self.search_games()
+                return
+            elif choice == 'n':
+                if next_cursor: cursors.append(next_cursor)
+                else: print("已經是最後一頁")
+            elif choice == 'p':
+                if len(cursors) > 1: cursors.pop()
+            elif choice == 's':
+                sort_idx = (sort_idx + 1) % len(STORE_SORTS)
+                cursors = [None]
+            elif choice == 'a':
+                author = input("作者帳號 (留空取消篩選): ").strip() or None
+                cursors = [None]
+            else:
+                try:
+                    game = games[int(choice)-1]
+                except (ValueError, IndexError):
+                    print("無效選擇"); continue
+                self.show_game_detail(game)
+                return
+
+    def search_games(self):
+        """以關鍵字搜尋遊戲名稱、簡介與作者 (結果依相關度排序，一次一頁)"""
+        query = input("搜尋關鍵字 (輸入 q 返回): ").strip()
+        if not query or query.lower() == 'q': return
+        offsets = [None]
+        while True:
+            res = self.request({"action": "SEARCH_GAMES", "query": query, "after": offsets[-1], "limit": PAGE_SIZE})
+            if res['status'] != 'SUCCESS':
+                print(f"[錯誤] {res.get('message')}"); return
+            games = res.get('games', [])
+            self.prefetch([g['name'] for g in games])
+
+            print(f"\n=== 搜尋「{query}」第 {len(offsets)} 頁 ===")
+            if not games: print("找不到符合的遊戲。")
+            for i, g in enumerate(games):
+                avg_rating = f"{g['avg_rating']:.1f}" if g.get('avg_rating') else "尚無"
+                print(f"{i+1}. {g['name']} [★ {avg_rating}] - {g['author_username']}")
+
+            choice = input("\n[編號] 查看詳情 [n] 下一頁 [p] 上一頁 [q] 返回: ").strip().lower()
+            if choice == 'q': return
+            elif choice == 'n':
+                if res.get('next'): offsets.append(res['next'])
+                else: print("已經是最後一頁")
+            elif choice == 'p':
+                if len(offsets) > 1: offsets.pop()
+            else:
+                try:
+                    game = games[int(choice)-1]
+                except (ValueError, IndexError):
+                    print("無效選擇"); continue
+                self.show_game_detail(game)
+                return
 
     def show_game_detail(self, game):
         """顯示遊戲詳細資訊與玩家評價 (符合 P1 要求)"""
@@ -144,11 +787,15 @@ class PlayerClient:
                 break
 
     def view_reviews(self, game_name):
-        send_json(self.sock, {"action": "GET_REVIEWS", "game_name": game_name})
-        res = recv_json(self.sock)
         print(f"\n--- {game_name} 評論列表 ---")
-        for r in res.get('reviews', []):
-            print(f"[{r['username']}] ★{r['rating']}: {r['comment']}")
+        after = None
+        while True:
+            res = self.request({"action": "GET_REVIEWS", "game_name": game_name, "after": after, "limit": PAGE_SIZE})
+            for r in res.get('reviews', []):
+                print(f"[{r['username']}] ★{r['rating']}: {r['comment']}")
+            after = res.get('next')
+            if not after or input("[n] 更多評論 [其他] 返回: ").strip().lower() != 'n':
+                break
 
     def write_review(self, game_name):
         """RQU-6: 撰寫評分與留言"""
@@ -158,13 +805,12 @@ class PlayerClient:
             if not 1 <= rating <= 5: raise ValueError
             comment = input("評論文字: ").strip()
             
-            send_json(self.sock, {
+            res = self.request({
                 "action": "SUBMIT_REVIEW", 
                 "game_name": game_name, 
                 "rating": rating, 
                 "comment": comment
             })
-            res = recv_json(self.sock)
             print(f"[{res['status']}] {res['message']}")
         except ValueError:
             print("[錯誤] 評分請輸入 1 到 5 之間的整數。")
@@ -174,7 +820,7 @@ class PlayerClient:
     def start_game_subprocess(self, game_id, ip, port):
         time.sleep(1.5)
         """啟動解壓後的遊戲 run.py"""
-        game_dir = os.path.join(current_dir, "downloads", self.user_data['username'], game_id)
+        game_dir = self.game_dir(game_id)
         script_path = os.path.join(game_dir, "run.py")
         
         if os.path.exists(script_path):
@@ -190,9 +836,10 @@ class PlayerClient:
 
     def list_rooms(self):
         """瀏覽房間列表，解決玩家看不到房號的問題"""
-        send_json(self.sock, {"action": "LIST_ROOMS"})
-        res = recv_json(self.sock)
+        res = self.request({"action": "LIST_ROOMS"})
         rooms = res.get('rooms', [])
+        # 房間裡的遊戲最可能馬上要玩，優先預抓
+        self.prefetch([r['game_id'] for r in rooms], urgent=True)
         print("\n=== 目前可加入房間 ===")
         if not rooms: print("目前無房間，快去建立一個吧！"); return
 
@@ -208,62 +855,68 @@ class PlayerClient:
         gid = pre_gid or input("請輸入遊戲名稱 (輸入 q 返回): ").strip()
         if gid.lower() == 'q' or not gid: return
 
-        # 1. 建立房間前先拿遊戲資訊以確保版本 (RQU-5 P2)
-        send_json(self.sock, {"action": "LIST_GAMES"})
-        games_res = recv_json(self.sock)
-        target_game = next((g for g in games_res['games'] if g['name'] == gid), None)
-        if not target_game:
-            print(f"[錯誤] 找不到遊戲: {gid}"); return
-        
-        # 強制版本檢查
-        self.ensure_latest_version(gid, target_game['version'])
-
-        # 2. 發送建立房間指令
-        send_json(self.sock, {"action": "CREATE_ROOM", "game_id": gid})
-        res = recv_json(self.sock)
+        # 1. 建立房間，回覆會附上遊戲目前的版本 (確保版本，RQU-5 P2)，不必再抓整份商城清單
+        res = self.request({"action": "CREATE_ROOM", "game_id": gid, "subscribe": True})
         
         if res['status'] == 'SUCCESS':
+            # 2. 強制版本檢查 (房間已建立，等待挑戰者的同時完成下載)
             room_id = res['room_id']
+            self.ensure_latest_version(gid, res['version'], room_id)
+
             print(f"\n[房主] 房間 ID: {room_id} 建立成功！")
             print("正在等待挑戰者加入... (按 Ctrl+C 取消等待)")
 
-            # ★ 關鍵修正：進入等待迴圈，不要讓函式結束
+            # ★ 關鍵修正：進入等待迴圈，不要讓函式結束 (房間事件由 Server 主動推播)
             try:
-                while True:
-                    time.sleep(1) # 每秒檢查一次
-                    send_json(self.sock, {"action": "CHECK_ROOM", "room_id": room_id})
-                    check_res = recv_json(self.sock)
-
-                    if check_res.get("game_start"):
-                        print("\n[系統] 挑戰者已加入！正在最終校驗版本...")
-                        # 房主在啟動前再次確認版本
-                        self.ensure_latest_version(check_res['game_id'], check_res['version'])
-                        
-                        print("[啟動] 正在連線至遊戲伺服器...")
-                        self.start_game_subprocess(
-                            check_res['game_id'], 
-                            check_res['game_ip'], 
-                            check_res['game_port']
-                        )
-                        break # 遊戲開始，跳出迴圈
+                ready = self.wait_for_game(room_id)
+                if ready:
+                    print("\n[系統] 挑戰者已加入！正在最終校驗版本...")
+                    # 房主在啟動前再次確認版本
+                    self.ensure_latest_version(ready['game_id'], ready['version'], room_id)
                     
-                    elif check_res.get("status") == "FAIL":
-                        print("\n[錯誤] 房間已被關閉或失效。")
-                        break
-                    else:
-                        # 顯示目前人數 (動畫效果)
-                        players = check_res.get("players", [])
-                        max_p = check_res.get("max_players", 2)
-                        sys.stdout.write(f"\r目前人數: {len(players)}/{max_p} ...")
-                        sys.stdout.flush()
+                    print("[啟動] 正在連線至遊戲伺服器...")
+                    self.start_game_subprocess(
+                        ready['game_id'], 
+                        ready['game_ip'], 
+                        ready['game_port']
+                    )
             except KeyboardInterrupt:
+                self.request({"action": "UNSUBSCRIBE_ROOM", "room_id": room_id})
                 print("\n[系統] 已取消等待房間。")
         else:
             print(f"[失敗] {res.get('message')}")
 
+    def wait_for_game(self, room_id):
+        """等待房間事件直到 game_ready，回傳含遊戲 Server 位址的事件"""
+        while True:
+            try:
+                event = self.sock.next_event()
+            except (ConnectionError, OSError):
+                print("\n[系統] 與大廳的連線中斷，正在重新連線...")
+                res = self.reconnect()
+                if res is None:
+                    return None
+                # 斷線期間遊戲可能已經開始，RESUME 會附上房間目前的狀態
+                status = res.get('rooms', {}).get(room_id)
+                if status is None:
+                    print("[系統] 房間已不存在"); return None
+                if status.get('game_start'):
+                    return status
+                continue
+            if event.get("room_id") != room_id:
+                continue
+            kind = event.get("event")
+            if kind == "player_joined":
+                # 顯示目前人數 (動畫效果)
+                sys.stdout.write(f"\r目前人數: {len(event['players'])}/{event['max_players']} ...")
+                sys.stdout.flush()
+            elif kind == "game_starting":
+                print("\n[系統] 人數已滿，遊戲伺服器啟動中...")
+            elif kind == "game_ready":
+                return event
+
     def join_room(self, room_id):
-        send_json(self.sock, {"action": "JOIN_ROOM", "room_id": room_id})
-        res = recv_json(self.sock)
+        res = self.request({"action": "JOIN_ROOM", "room_id": room_id, "subscribe": True})
 
         if res['status'] != 'SUCCESS':
             print("加入失敗:", res.get('message'))
@@ -271,26 +924,27 @@ class PlayerClient:
 
         print("加入成功！等待房主啟動遊戲...")
 
-        while True:
-            time.sleep(1)
-            send_json(self.sock, {"action": "CHECK_ROOM", "room_id": room_id})
-            check = recv_json(self.sock)
-
-            if check.get("game_start"):
-                print("[系統] 遊戲已啟動，正在校驗版本...")
-
-                self.ensure_latest_version(
-                    check['game_id'],
-                    check['version']
-                )
-
-                self.start_game_subprocess(
-                    check['game_id'],
-                    check['game_ip'],
-                    check['game_port']
-                )
-                break
+        check = self.wait_for_game(room_id)
+        if not check: return
+        print("[系統] 遊戲已啟動，正在校驗版本...")
+
+        self.ensure_latest_version(
+            check['game_id'],
+            check['version'],
+            room_id
+        )
+
+        self.start_game_subprocess(
+            check['game_id'],
+            check['game_ip'],
+            check['game_port']
+        )
+
 
+    def logout(self):
+        self.request({"action": "LOGOUT", "token": self.token})
+        self.drop_login()
+        print("已登出")
 
     def main_menu(self):
         self.connect()
@@ -311,7 +965,7 @@ class PlayerClient:
                 if c == '1': self.list_games()
                 elif c == '2': self.list_rooms()
                 elif c == '3': self.create_room()
-                elif c == '4': self.user_data = None; print("已登出")
+                elif c == '4': self.logout()
 
 if __name__ == "__main__":
     client = PlayerClient()
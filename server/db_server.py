@@ -1,150 +1,367 @@
 import sqlite3
 import os
 import threading
+import time
+import queue
+import functools
+from concurrent.futures import Future
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_store.db")
-db_lock = threading.Lock()
+CACHED_STATEMENTS = 256  # 每條連線快取的 prepared statement 數量 (同一段 SQL 不必重新編譯)
+BUSY_TIMEOUT = 5.0  # 其他程序 (例如手動開 sqlite3 CLI) 持有寫入鎖時的等待秒數
+GROUP_COMMIT_WINDOW = 0.002  # 寫入執行緒收到第一筆後再等多久，把這段時間內的寫入併成一個交易
+GROUP_COMMIT_MAX = 256       # 單一交易最多幾筆寫入
+_local = threading.local()
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row 
+    """取得目前執行緒專屬的連線 (第一次呼叫時建立，之後重複使用，不需要 close)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        # WAL：讀取不會被寫入擋住；NORMAL 在 WAL 下只在 checkpoint 時 fsync
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
     return conn
 
 def init_db():
-    with db_lock:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, role TEXT DEFAULT "player")')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS games (
+    """建立 / 升級資料表；需在開始處理請求 (寫入執行緒啟動) 之前呼叫"""
+    conn = get_db_connection()
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, role TEXT DEFAULT "player")')
+        conn.execute('''CREATE TABLE IF NOT EXISTS games (
             game_id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, 
             version TEXT, description TEXT, exe_path TEXT, author_username TEXT, max_players INTEGER DEFAULT 2)''')
-        cursor.execute('CREATE TABLE IF NOT EXISTS reviews (id INTEGER PRIMARY KEY AUTOINCREMENT, game_name TEXT, username TEXT, rating INTEGER, comment TEXT)')
-        cursor.execute('CREATE TABLE IF NOT EXISTS play_history (username TEXT, game_name TEXT, PRIMARY KEY (username, game_name))')
-        conn.commit()
-        conn.close()
+        conn.execute('CREATE TABLE IF NOT EXISTS reviews (id INTEGER PRIMARY KEY AUTOINCREMENT, game_name TEXT, username TEXT, rating INTEGER, comment TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS play_history (username TEXT, game_name TEXT, PRIMARY KEY (username, game_name))')
+        upgrade_schema(conn)
+        ensure_search_index(conn)
+
+# 每一版 schema 升級的 SQL，索引 i 代表從 user_version = i 升到 i + 1
+SCHEMA_UPGRADES = [
+    [
+        # 評分彙總直接存在 games 上，由 add_review 在同一個交易內累加，商城列表不必掃 reviews
+        "ALTER TABLE games ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE games ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_reviews_game_name ON reviews (game_name)",
+        "CREATE INDEX IF NOT EXISTS idx_games_author ON games (author_username)",
+        '''UPDATE games SET
+            rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM reviews WHERE reviews.game_name = games.name),
+            review_count = (SELECT COUNT(*) FROM reviews WHERE reviews.game_name = games.name)''',
+    ],
+    [
+        # 分頁排序用：平均評分也存起來 (尚無評價為 0)，才能建索引做 keyset 分頁
+        "ALTER TABLE games ADD COLUMN avg_rating REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE games ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0",
+        "UPDATE games SET avg_rating = CASE WHEN review_count > 0 THEN CAST(rating_sum AS REAL) / review_count ELSE 0 END",
+        "UPDATE games SET updated_at = CAST(strftime('%s', 'now') AS INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_games_rating ON games (avg_rating DESC, game_id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_games_updated ON games (updated_at DESC, game_id DESC)",
+    ],
+    [
+        # 遊戲檔案改存在以 sha256 命名的 artifact store，games 只記錄目前版本的 digest (舊資料為 NULL，沿用舊路徑)
+        "ALTER TABLE games ADD COLUMN digest TEXT",
+    ],
+]
+
+def upgrade_schema(conn):
+    """依 PRAGMA user_version 套用尚未執行過的升級 (需在交易內呼叫)"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(SCHEMA_UPGRADES) and not conn.in_transaction:
+        conn.execute("BEGIN")  # ALTER TABLE 不會自動開交易，明確開始，升級中途失敗才能整批 rollback
+    for i in range(version, len(SCHEMA_UPGRADES)):
+        for sql in SCHEMA_UPGRADES[i]:
+            conn.execute(sql)
+        print(f"[DB] Schema 升級至第 {i + 1} 版")
+    if version < len(SCHEMA_UPGRADES):
+        conn.execute(f"PRAGMA user_version = {len(SCHEMA_UPGRADES)}")
+
+# 全文搜尋索引 (FTS5)：trigram 分詞可做中文子字串搜尋，不支援時退回 unicode61；
+# 連 FTS5 都沒有的 SQLite 則 search_games 改用 LIKE 掃表
+SEARCH_TOKENIZERS = ("trigram", "unicode61")
+_search_index = None  # None 表示還沒檢查；False 表示沒有索引；否則為 (分詞器, 最短可用詞長)
+
+def ensure_search_index(conn):
+    """建立 games_fts 並從 games 匯入既有資料 (需在交易內呼叫)"""
+    global _search_index
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'games_fts'").fetchone() is None:
+        for tokenizer in SEARCH_TOKENIZERS:
+            try:
+                conn.execute(f"CREATE VIRTUAL TABLE games_fts USING fts5(name, description, author_username, tokenize='{tokenizer}')")
+            except sqlite3.OperationalError:
+                continue
+            conn.execute("INSERT INTO games_fts (rowid, name, description, author_username) "
+                         "SELECT game_id, name, COALESCE(description, ''), author_username FROM games")
+            print(f"[DB] 已建立全文搜尋索引 (tokenize={tokenizer})")
+            break
+        else:
+            print("[DB] 這個 SQLite 沒有 FTS5，搜尋改用 LIKE")
+    _search_index = None
+
+def search_index(conn):
+    global _search_index
+    if _search_index is None:
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'games_fts'").fetchone()
+        if row is None:
+            _search_index = False
+        else:
+            # trigram 索引無法比對少於 3 個字元的詞
+            _search_index = ("trigram", 3) if "trigram" in row[0] else ("unicode61", 1)
+    return _search_index
+
+# === 寫入：全部交給單一寫入執行緒 (group commit) ===
+# 呼叫寫入函式只會把工作排進佇列並回傳 concurrent.futures.Future，交易 commit 後才會有結果；
+# 需要結果的呼叫端 (例如 event loop 上用 asyncio.wrap_future) 等 Future，不需要的可以直接丟著不管。
+# 寫入執行緒把 GROUP_COMMIT_WINDOW 內累積的工作放進同一個交易，一批只 commit (fsync) 一次；
+# 每筆工作各自一個 SAVEPOINT，其中一筆失敗只會撤銷它自己。
+# 讀取不經過這裡：WAL 下讀取各自看到一致的快照，不必等寫入，也不會擋住寫入。
+
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_start_lock = threading.Lock()
+
+def submit_write(func, *args):
+    """排入一筆寫入，func(conn, *args) 會在寫入執行緒的交易中執行"""
+    global _writer_thread
+    if _writer_thread is None:
+        with _writer_start_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+                _writer_thread.start()
+    future = Future()
+    _write_queue.put((func, args, future))
+    return future
 
-def register_user(username, password, role='player'):
+def write_op(func):
+    """把 func(conn, ...) 包成排入寫入執行緒、回傳 Future 的寫入函式"""
+    @functools.wraps(func)
+    def submit(*args):
+        return submit_write(func, *args)
+    return submit
 
-    with db_lock:
-        conn = get_db_connection()
+def _next_batch():
+    batch = [_write_queue.get()]
+    deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+    while len(batch) < GROUP_COMMIT_MAX:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
         try:
-            conn.execute(
-                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                (username, password, role)
-            )
+            batch.append(_write_queue.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+def _writer_loop():
+    conn = get_db_connection()
+    while True:
+        batch = _next_batch()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((future, func(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    results.append((future, None, e))
+                conn.execute("RELEASE op")
             conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False 
         except Exception as e:
-            print(f"[DB Error] Register: {e}")
-            return False
-        finally:
-            conn.close()
+            print(f"[DB Error] Group commit ({len(batch)} 筆): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            # 整批失敗 (例如 BEGIN 等不到寫入鎖、RELEASE 失敗)：還沒輪到的工作也要通知，否則呼叫端會永遠等下去
+            for _, _, future in batch:
+                if future.done():
+                    continue
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            continue
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+@write_op
+def register_user(conn, username, password, role='player'):
+    try:
+        conn.execute(
+            "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+            (username, password, role)
+        )
+        return True
+    except sqlite3.IntegrityError:
+        return False 
 
 def login_check(username, password):
-    with db_lock:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM users WHERE username = ? AND password = ?", 
-            (username, password)
+    user = get_db_connection().execute(
+        "SELECT * FROM users WHERE username = ? AND password = ?", 
+        (username, password)
+    ).fetchone()
+    
+    if user:
+        return dict(user)
+    return None
+
+@write_op
+def add_game(conn, name, version, description, exe_path, author, max_players, digest=None):
+    """
+    將上架的遊戲資訊存入資料庫 (符合 PDF Step 6)
+    只有同名 (IntegrityError) 回傳 False；其他錯誤往上丟給寫入執行緒，ROLLBACK TO op 一併撤銷 games 與 games_fts
+    """
+    try:
+        # 同名遊戲下架後重新上架時，沿用 reviews 裡既有的評價 (與舊的 JOIN 查詢結果一致)
+        cur = conn.execute(
+            '''INSERT INTO games (name, version, description, exe_path, author_username, max_players, digest,
+                                 rating_sum, review_count, avg_rating, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?,
+                       (SELECT COALESCE(SUM(rating), 0) FROM reviews WHERE game_name = ?),
+                       (SELECT COUNT(*) FROM reviews WHERE game_name = ?),
+                       (SELECT COALESCE(AVG(rating), 0) FROM reviews WHERE game_name = ?), ?)''',
+            (name, version, description, exe_path, author, max_players, digest, name, name, name, int(time.time()))
         )
-        user = cursor.fetchone()
-        conn.close()
-        
-        if user:
-            return dict(user)
-        return None
-
-def add_game(name, version, description, exe_path, author, max_players):
-    """將上架的遊戲資訊存入資料庫 (符合 PDF Step 6)"""
-    with db_lock:
-        conn = get_db_connection()
-        try:
-            conn.execute(
-                "INSERT INTO games (name, version, description, exe_path, author_username, max_players) VALUES (?, ?, ?, ?, ?, ?)",
-                (name, version, description, exe_path, author, max_players)
-            )
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"[DB Error] Add Game: {e}")
-            return False
-        finally:
-            conn.close()
+    except sqlite3.IntegrityError:
+        return False
+    if search_index(conn):
+        conn.execute("INSERT INTO games_fts (rowid, name, description, author_username) VALUES (?, ?, ?, ?)",
+                     (cur.lastrowid, name, description or '', author))
+    return True
 
 def get_games_by_author(author):
     """取得特定開發者上架的遊戲列表 (符合 PDF Step 7)"""
-    with db_lock:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM games WHERE author_username = ?", (author,))
-        games = cursor.fetchall()
-        conn.close()
-        return [dict(g) for g in games]
-
-def update_game_version_db(name, author, new_version, new_desc, new_max_players):
-    """RQU-4: 更新遊戲版本資訊"""
-    with db_lock:
-        conn = get_db_connection()
-        try:
-            # 明確指定欄位名稱，避免 game_id 造成數量不符
-            conn.execute(
-                "UPDATE games SET version = ?, description = ?, max_players = ? WHERE name = ? AND author_username = ?",
-                (new_version, new_desc, new_max_players, name, author)
-            )
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"[DB Error] Update Game: {e}")
-            return False
-        finally:
-            conn.close()
-
-def delete_game_db(name, author):
-    """RQU-4: 刪除遊戲記錄"""
-    with db_lock:
-        conn = get_db_connection()
-        try:
-            conn.execute(
-                "DELETE FROM games WHERE name = ? AND author_username = ?",
-                (name, author)
-            )
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"[DB Error] Delete Game: {e}")
-            return False
-        finally:
-            conn.close()
-
-def record_play(username, game_name):
-    with db_lock:
-        conn = get_db_connection()
-        print(f"[DB Debug] 嘗試寫入遊玩紀錄: 使用者={username}, 遊戲={game_name}", flush=True)
-        conn.execute("INSERT OR IGNORE INTO play_history (username, game_name) VALUES (?, ?)", (username, game_name))
-        conn.commit()
-        conn.close()
-
-def add_review(game_name, username, rating, comment):
-    with db_lock:
-        conn = get_db_connection()
-        print(f"[DB Debug] 檢查評價資格: 使用者={username}, 遊戲={game_name}", flush=True)
-        played = conn.execute("SELECT 1 FROM play_history WHERE username=? AND game_name=?", (username, game_name)).fetchone()
-        if not played: 
-            print(f"[DB Debug] 資格檢查失敗！資料庫找不到該紀錄") # 加上這行
-            return False, "需遊玩過才能評分"
-        conn.execute("INSERT INTO reviews (game_name, username, rating, comment) VALUES (?, ?, ?, ?)", (game_name, username, rating, comment))
-        conn.commit()
-        conn.close()
-        return True, "評價成功"
-
-def get_game_reviews(game_name):
+    games = get_db_connection().execute("SELECT * FROM games WHERE author_username = ?", (author,)).fetchall()
+    return [dict(g) for g in games]
+
+@write_op
+def update_game_version_db(conn, name, author, new_version, new_desc, new_max_players, new_digest=None):
+    """
+    RQU-4: 更新遊戲版本資訊；new_digest 為新版本在 artifact store 的位置，改指標即完成切換
+    錯誤往上丟給寫入執行緒撤銷整筆，digest 不會在 games_fts 更新失敗時先指到新版本
+    """
+    # 明確指定欄位名稱，避免 game_id 造成數量不符
+    conn.execute(
+        "UPDATE games SET version = ?, description = ?, max_players = ?, digest = COALESCE(?, digest), updated_at = ? "
+        "WHERE name = ? AND author_username = ?",
+        (new_version, new_desc, new_max_players, new_digest, int(time.time()), name, author)
+    )
+    if search_index(conn):
+        conn.execute("UPDATE games_fts SET description = ? WHERE rowid = (SELECT game_id FROM games WHERE name = ? AND author_username = ?)",
+                     (new_desc or '', name, author))
+    return True
+
+@write_op
+def delete_game_db(conn, name, author):
+    """RQU-4: 刪除遊戲記錄 (錯誤往上丟，games 與 games_fts 一起撤銷)"""
+    if search_index(conn):
+        conn.execute("DELETE FROM games_fts WHERE rowid IN (SELECT game_id FROM games WHERE name = ? AND author_username = ?)",
+                     (name, author))
+    conn.execute(
+        "DELETE FROM games WHERE name = ? AND author_username = ?",
+        (name, author)
+    )
+    return True
+
+@write_op
+def record_play(conn, usernames, game_name):
+    """一次寫入整個房間的遊玩紀錄"""
+    print(f"[DB Debug] 嘗試寫入遊玩紀錄: 使用者={usernames}, 遊戲={game_name}", flush=True)
+    conn.executemany("INSERT OR IGNORE INTO play_history (username, game_name) VALUES (?, ?)",
+                     [(u, game_name) for u in usernames])
+
+@write_op
+def add_review(conn, game_name, username, rating, comment):
+    # 資格檢查也在寫入執行緒上做：先排入的 record_play 一定已經執行過
+    print(f"[DB Debug] 檢查評價資格: 使用者={username}, 遊戲={game_name}", flush=True)
+    played = conn.execute("SELECT 1 FROM play_history WHERE username=? AND game_name=?", (username, game_name)).fetchone()
+    if not played: 
+        print(f"[DB Debug] 資格檢查失敗！資料庫找不到該紀錄") # 加上這行
+        return False, "需遊玩過才能評分"
+    conn.execute("INSERT INTO reviews (game_name, username, rating, comment) VALUES (?, ?, ?, ?)", (game_name, username, rating, comment))
+    conn.execute('''UPDATE games SET rating_sum = rating_sum + ?, review_count = review_count + 1,
+                        avg_rating = CAST(rating_sum + ? AS REAL) / (review_count + 1) WHERE name = ?''',
+                 (rating, rating, game_name))
+    return True, "評價成功"
+
+# LIST_GAMES 的排序方式 -> (ORDER BY, keyset 條件, 游標欄位)；每一種都有對應的索引 (name 為 UNIQUE)
+GAME_SORTS = {
+    "name": ("name", "name > ?", ("name",)),
+    "rating": ("avg_rating DESC, game_id DESC", "(avg_rating, game_id) < (?, ?)", ("avg_rating", "game_id")),
+    "updated": ("updated_at DESC, game_id DESC", "(updated_at, game_id) < (?, ?)", ("updated_at", "game_id")),
+}
+
+def list_games_page(sort="name", author=None, after=None, limit=20):
+    """商城列表 (P1 要求，含平均評分與評論數)，以 keyset 分頁；回傳 (games, 下一頁游標或 None)"""
+    order, keyset, cursor_cols = GAME_SORTS[sort]
+    where, params = [], []
+    if author:
+        where.append("author_username = ?")
+        params.append(author)
+    if after is not None:
+        if (not isinstance(after, (list, tuple)) or len(after) != len(cursor_cols)
+                or not all(isinstance(v, (str, int, float)) for v in after)):
+            raise ValueError("invalid cursor")
+        where.append(keyset)
+        params.extend(after)
+    query = "SELECT * FROM games"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += f" ORDER BY {order} LIMIT ?"
+    # 多取一筆，用來判斷是否還有下一頁
+    rows = get_db_connection().execute(query, params + [limit + 1]).fetchall()
+    games = [dict(row) for row in rows[:limit]]
+    next_cursor = [games[-1][c] for c in cursor_cols] if len(rows) > limit else None
+    return games, next_cursor
+
+def search_games(query, after=None, limit=20):
+    """SEARCH_GAMES：依相關度排序 (名稱 > 作者 > 簡介)，以 offset 游標分頁；回傳 (games, 下一頁游標或 None)"""
+    terms = query.split()
+    if not terms:
+        return [], None
+    offset = int(after or 0)
     conn = get_db_connection()
-    res = conn.execute("SELECT username, rating, comment FROM reviews WHERE game_name=?", (game_name,)).fetchall()
-    conn.close()
-    return [dict(r) for r in res]
+    index = search_index(conn)
+    if index and all(len(t) >= index[1] for t in terms):
+        # 每個詞都包成片語，避免使用者輸入被當成 FTS 語法；多個詞之間為 AND
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+        rows = conn.execute(
+            '''SELECT g.* FROM games_fts JOIN games g ON g.game_id = games_fts.rowid
+               WHERE games_fts MATCH ? ORDER BY bm25(games_fts, 10.0, 1.0, 5.0) LIMIT ? OFFSET ?''',
+            (match, limit + 1, offset)).fetchall()
+    else:
+        where = " AND ".join(["(name LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\' OR author_username LIKE ? ESCAPE '\\')"] * len(terms))
+        params = []
+        for t in terms:
+            pattern = "%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params += [pattern] * 3
+        rows = conn.execute(f"SELECT * FROM games WHERE {where} ORDER BY name LIMIT ? OFFSET ?",
+                            params + [limit + 1, offset]).fetchall()
+    games = [dict(row) for row in rows[:limit]]
+    return games, (offset + limit if len(rows) > limit else None)
+
+def get_game_info(name):
+    """建立房間與下載時查詢遊戲版本、人數上限與檔案 digest"""
+    row = get_db_connection().execute("SELECT version, max_players, digest FROM games WHERE name = ?", (name,)).fetchone()
+    return dict(row) if row else None
+
+def get_game_digests():
+    """目前仍被遊戲引用的 artifact digest (artifact store 回收時使用)"""
+    rows = get_db_connection().execute("SELECT DISTINCT digest FROM games WHERE digest IS NOT NULL").fetchall()
+    return {row[0] for row in rows}
+
+def get_game_reviews(game_name, after=None, limit=20):
+    """依留言順序分頁 (idx_reviews_game_name 內含 id)；回傳 (reviews, 下一頁游標或 None)"""
+    res = get_db_connection().execute(
+        "SELECT id, username, rating, comment FROM reviews WHERE game_name = ? AND id > ? ORDER BY id LIMIT ?",
+        (game_name, int(after or 0), limit + 1)).fetchall()
+    reviews = [dict(r) for r in res[:limit]]
+    return reviews, (reviews[-1]['id'] if len(res) > limit else None)
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
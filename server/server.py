@@ -1,5 +1,6 @@
 import socket
-import threading
+import asyncio
+import functools
 import json
 import sys
 import os
@@ -7,40 +8,88 @@ import subprocess
 import shutil
 import zipfile
 import time
+import hmac
+import hashlib
+import secrets
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
 # --- Import 自訂模組 ---
-from common.protocol import send_json, recv_json, recv_frame, send_frame
+from common.protocol import AsyncFramedConnection, choose_codec, choose_compression, split_chunk, TRANSFER_CHUNKED, TRANSFER_RAW
 from common.constant import SERVER_PORT, SERVER_IP
-from db_server import register_user, login_check, add_game, get_db_connection, get_games_by_author, record_play, add_review, get_game_reviews
+from db_server import (register_user, login_check, add_game, get_games_by_author, record_play, add_review,
+                       get_game_reviews, list_games_page, search_games, get_game_info, update_game_version_db, delete_game_db,
+                       get_game_digests, GAME_SORTS)
 
 # --- Server 設定 ---
 HOST = '0.0.0.0'  # 監聽所有網卡 (讓別人也能連進來)
 PORT = SERVER_PORT
+LISTEN_BACKLOG = 1024
+DOWNLOAD_CHUNK = 60000
+MAX_INFLIGHT = 8  # 單一連線同時並行處理的請求上限
+MAX_REQUEST_LEN = 1024 * 1024  # Client 請求重組後的上限 (回覆則可到 protocol.MAX_MESSAGE_LEN)
+STREAM_ACTIONS = {"UPLOAD", "UPDATE_GAME", "DOWNLOAD", "SYNC_GAME"}  # 會在連線上接續收送檔案，必須依序處理
+PAGE_SIZE = 20       # LIST_GAMES / GET_REVIEWS 未指定 limit 時的每頁筆數
+MAX_PAGE_SIZE = 100
+CATALOG_CACHE_SIZE = 256  # 快取的查詢結果 (分頁、單一遊戲) 數量上限
+PACKAGE_CACHE_SIZE = 64 * 1024 * 1024      # 記憶體中熱門 client.zip 的總大小上限
+PACKAGE_CACHE_ITEM_MAX = 16 * 1024 * 1024  # 超過此大小的 zip 不放記憶體，直接 sendfile
+UPLOAD_WORKERS = 2        # 同時解壓 / 重新打包的上傳工作數，其餘排隊
+MAX_UPLOAD_JOBS_PER_DEVELOPER = 2  # 每位開發者同時進行中 (傳送、排隊、處理) 的上傳工作上限
+UPLOAD_JOB_TTL = 3600     # 完成的上傳工作保留多久供 UPLOAD_STATUS 查詢
+INCOMING_DIR = os.path.join(current_dir, "uploaded_game", ".incoming")  # 上傳中 / 待處理的原始 zip
+STORE_DIR = os.path.join(current_dir, "uploaded_game", "store")  # artifact store：每個版本一個 {sha256}/ 資料夾，建立後不再修改
+ARTIFACT_GC_INTERVAL = 600  # 定期回收房間已結束的舊版本
+SESSION_TTL = 12 * 3600   # LOGIN 發出的 session token 有效秒數
+SESSION_SECRET = secrets.token_bytes(32)  # 簽章金鑰；session 只存在記憶體，Server 重啟後本來就要重新登入
 
+# 房間與線上名單只會在 event loop 執行緒上被修改，因此不需要 threading.Lock
 rooms = {}
 room_id_counter = 100
-rooms_lock = threading.Lock()
-online_users = {}  # username -> conn
-online_users_lock = threading.Lock()
+online_users = {}  # username -> AsyncFramedConnection
+room_subscribers = {}  # room_id -> set(ClientSession)，等待中的玩家訂閱房間事件，取代每秒 CHECK_ROOM
+active_connections = 0
+upload_jobs = {}  # job_id -> 上傳工作狀態 (receiving -> queued -> processing -> done / failed)
+upload_job_counter = 0
+game_package_locks = {}  # game_name -> asyncio.Lock，同一款遊戲的版本切換依上傳順序進行
+background_tasks = set()  # 保留背景 task 的參照，避免被 GC
+sessions = {}  # session id -> {"user": user_data, "expires": 時間}，斷線重連時用 RESUME 取回登入狀態
 
+# 商城目錄快取：version 每次失效就加一 (從啟動時間起算，Server 重啟後也不會與舊值重複)
+# entries 存放各分頁與單一遊戲的查詢結果；UPLOAD / UPDATE_GAME / DELETE_GAME / SUBMIT_REVIEW 成功後失效
+catalog = {"version": time.time_ns() // 1000, "entries": {}, "loading": {}}  # loading: key -> (version, future)
 
-def start_game_process(game_id, room_id):
+# 玩家下載用 client.zip 的 LRU 快取：房間滿員時所有玩家幾乎同時下載同一個版本
+package_cache = {"entries": OrderedDict(), "bytes": 0, "loading": {}}  # entries: digest -> bytes；loading: digest -> future
+
+# 會阻塞的工作 (SQLite 讀取、解壓縮、啟動遊戲 Server) 丟到 executor，避免卡住 event loop
+# SQLite 寫入則由 db_server 的寫入執行緒批次處理，直接回傳 Future
+db_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="db")
+io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
+package_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="package")
+
+
+async def run_blocking(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def start_game_process(server_dir, room_id):
     temp_sock = socket.socket()
     temp_sock.bind(('', 0))
     game_port = temp_sock.getsockname()[1]
     temp_sock.close()
 
-    game_dir = os.path.join(current_dir, "uploaded_game", game_id)
-    server_dir = os.path.join(game_dir, "server")
     server_script = os.path.join(server_dir, "game_server.py")
 
     cmd = [sys.executable, server_script, str(game_port), str(room_id)]
 
-    subprocess.Popen(
+    process = subprocess.Popen(
         cmd, 
         cwd=server_dir,
         stdout=subprocess.PIPE,
@@ -48,305 +97,882 @@ def start_game_process(game_id, room_id):
         text=True
     )
     time.sleep(1.0)
-    return game_port
+    return game_port, process
+
+
+def game_paths(game_name, digest):
+    """回傳 (遊戲 server 資料夾, 玩家下載用 zip)；digest 為 None 的舊資料沿用 uploaded_game/{game_name} 的舊路徑"""
+    if digest:
+        artifact = os.path.join(STORE_DIR, digest)
+        return os.path.join(artifact, "package", "server"), os.path.join(artifact, "client.zip")
+    return (os.path.join(current_dir, "uploaded_game", game_name, "server"),
+            os.path.join(current_dir, "uploaded_game", f"{game_name}.zip"))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(functools.partial(f.read, 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def package_sha256(path, mtime_ns, size):
+    """client.zip 的 sha256；以 (路徑, 修改時間, 大小) 為 key，artifact 只算一次，舊路徑的檔案被覆蓋後也會重算"""
+    return file_sha256(path)
+
+
+def build_manifest(client_dir):
+    """client 資料夾內每個檔案的 sha256 與大小，key 為以 / 分隔的相對路徑 (與 client.zip 內的名稱相同)"""
+    files = {}
+    for root, _, names in os.walk(client_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, client_dir).replace(os.sep, "/")
+            files[rel] = {"sha256": file_sha256(path), "size": os.path.getsize(path)}
+    return files
+
+
+@functools.lru_cache(maxsize=64)
+def load_manifest(digest):
+    """讀取版本的 manifest；artifact 建立後不再變動，可以放心快取"""
+    path = os.path.join(STORE_DIR, digest, "manifest.json")
+    if not os.path.exists(path):
+        return build_manifest(os.path.join(STORE_DIR, digest, "package", "client"))
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def extract_game_package(zip_path, digest, missing_msg):
+    """
+    把開發者上傳的 zip 存成 STORE_DIR/{digest}：package/ 為完整解壓內容，client.zip 為玩家下載專用的 client-only zip，
+    manifest.json 為 client 檔案清單 (SYNC_GAME 差異更新用)
+    先在暫存資料夾做好再 rename 成正式名稱；同一個 digest 已存在 (重複上傳) 就直接沿用，完成後內容不再變動
+    """
+    artifact = os.path.join(STORE_DIR, digest)
+    if os.path.isdir(artifact):
+        return
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=STORE_DIR)
+    try:
+        extract_path = os.path.join(staging, "package")
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            bad_file = zf.testzip()
+            if bad_file is not None:
+                raise Exception(f"壓縮檔損毀: {bad_file}")
+            zf.extractall(extract_path)
+
+        client_dir = os.path.join(extract_path, "client")
+        if not os.path.isdir(client_dir):
+            raise Exception(missing_msg)
+
+        # 重新打包，確保 UPLOAD 與 UPDATE_GAME 的結構一致
+        shutil.make_archive(os.path.join(staging, "client"), "zip", client_dir)
+        with open(os.path.join(staging, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(build_manifest(client_dir), f)
+        try:
+            os.rename(staging, artifact)
+        except OSError:
+            # 另一個相同內容的上傳先完成了
+            if not os.path.isdir(artifact):
+                raise
+    finally:
+        if os.path.exists(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def remove_artifacts(live):
+    """刪除 STORE_DIR 中不在 live 內的版本 (以及中斷留下的暫存資料夾)，回傳刪除的數量"""
+    removed = 0
+    for name in os.listdir(STORE_DIR):
+        if name in live:
+            continue
+        if name.startswith(".staging-") and time.time() - os.path.getmtime(os.path.join(STORE_DIR, name)) < UPLOAD_JOB_TTL:
+            continue  # 可能還在解壓中
+        shutil.rmtree(os.path.join(STORE_DIR, name), ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def pinned_digests():
+    """房間 (等待中或遊戲 Server 仍在執行) 與尚未寫入資料庫的上傳工作所引用的 digest"""
+    pinned = {job["digest"] for job in upload_jobs.values()
+              if job.get("digest") and job["state"] not in ("done", "failed")}
+    for room in rooms.values():
+        process = room.get("process")
+        if room.get("digest") and (room['status'] == "WAITING" or (process and process.poll() is None)):
+            pinned.add(room["digest"])
+    return pinned
+
+
+async def collect_artifacts():
+    """回收沒有任何遊戲或房間引用的舊版本；失敗只記錄下來，下次再回收 (呼叫端多半是沒人 await 的背景 task)"""
+    # 查資料庫前後各取一次 pinned：查詢期間剛寫入資料庫的上傳、剛建立的房間都不會被誤刪
+    pinned = pinned_digests()
+    try:
+        live = await run_blocking(db_executor, get_game_digests)
+        removed = await run_blocking(io_executor, remove_artifacts, live | pinned | pinned_digests())
+    except Exception as e:
+        print(f"[Artifact] 回收失敗: {e}")
+        return
+    if removed:
+        print(f"[Artifact] 已回收 {removed} 個未使用的版本")
+
+
+async def artifact_gc_loop():
+    while True:
+        await collect_artifacts()
+        await asyncio.sleep(ARTIFACT_GC_INTERVAL)
+
+
+def remove_game_files(game_name):
+    zip_path = os.path.join(current_dir, "uploaded_game", f"{game_name}.zip")
+    folder_path = os.path.join(current_dir, "uploaded_game", game_name)
+    if os.path.exists(zip_path): os.remove(zip_path)
+    if os.path.exists(folder_path): shutil.rmtree(folder_path)
+
+
+def write_chunk(f, digest, data):
+    f.write(data)
+    digest.update(data)
+
+
+async def receive_file(conn, zip_path, request):
+    """
+    接收開發者上傳的 zip，一次只在記憶體中放一個 frame；寫檔與 sha256 計算交給 io_executor
+    - transfer = "chunked"：每個 frame 帶 offset，資料收完後再收一個帶 sha256 的訊息比對
+    - 舊版 Client：直接送原始 frame，直到收滿 size
+    先寫到同目錄的暫存檔，完整收到 (且校驗通過) 才換成正式檔名，中斷時不會留下半個 zip
+    回傳檔案的 sha256 (hex)，即此版本在 artifact store 的名稱
+    """
+    file_size = request['size']
+    chunked = request.get("transfer") == TRANSFER_CHUNKED
+    fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(zip_path))
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            received = 0
+            while received < file_size:
+                frame = await conn.recv_frame()
+                if chunked:
+                    offset, data = split_chunk(frame)
+                    if offset != received:
+                        raise ValueError(f"分段 offset 錯誤: {offset} (預期 {received})")
+                else:
+                    if not frame: break
+                    data = frame
+                if received + len(data) > file_size:
+                    raise ValueError("收到的資料超過宣告的大小")
+                await run_blocking(io_executor, write_chunk, f, digest, data)
+                received += len(data)
+        if chunked:
+            trailer = await conn.recv_json()
+            if trailer.get("sha256") != digest.hexdigest():
+                raise ValueError("檔案校驗失敗 (sha256 不符)")
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest.hexdigest()
+
+
+async def send_file(conn, path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = await run_blocking(io_executor, f.read, DOWNLOAD_CHUNK)
+            if not chunk:
+                break
+            conn.write_frame(chunk)
+            await conn.drain()
+
+
+class ClientSession:
+    """單一連線的狀態"""
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.user_data = None  # 用來紀錄目前連線的使用者是誰 (登入後才有值)
+        self.inflight = set()  # 帶 req_id、正在並行處理中的請求
+        self.slots = asyncio.Semaphore(MAX_INFLIGHT)
+        self.subscriptions = set()  # 已訂閱事件的 room_id
+
+
+def subscribe_room(session, rid):
+    room_subscribers.setdefault(rid, set()).add(session)
+    session.subscriptions.add(rid)
+
+
+def unsubscribe_room(session, rid):
+    subs = room_subscribers.get(rid)
+    if subs is not None:
+        subs.discard(session)
+        if not subs:
+            room_subscribers.pop(rid, None)
+    session.subscriptions.discard(rid)
+
+
+async def push_event(session, event):
+    try:
+        await session.conn.send_json(event)
+    except Exception as e:
+        print(f"[推播失敗] {session.addr}: {e}")
+
+
+def publish_room_event(rid, event, **fields):
+    """推播房間事件給所有訂閱者；每個訂閱者各自一個 task，慢的 Client 不會拖住發送端"""
+    message = {"event": event, "room_id": rid, **fields}
+    for session in list(room_subscribers.get(rid, ())):
+        task = asyncio.ensure_future(push_event(session, message))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+def room_status(room):
+    """CHECK_ROOM 與 SUBSCRIBE_ROOM 共用的房間狀態"""
+    if room and room.get("game_port"):
+        return {
+            "status": "SUCCESS",
+            "game_start": True,
+            "game_id": room['game_id'],
+            "version": room.get('version'),
+            "game_ip": SERVER_IP,
+            "game_port": room['game_port']
+        }
+    return {
+        "status": "SUCCESS",
+        "game_start": False,
+        "players": room['players'] if room else [],
+        "max_players": room['max_players'] if room else 2
+    }
+
+
+def sign_session(sid, expires, username):
+    return hmac.new(SESSION_SECRET, f"{sid}.{expires}.{username}".encode(), hashlib.sha256).hexdigest()
+
+
+def issue_session(user):
+    """建立 session 並回傳 token: "<session id>.<到期時間>.<HMAC>" """
+    now = int(time.time())
+    for sid in [k for k, v in sessions.items() if v["expires"] <= now]:
+        del sessions[sid]
+    sid = secrets.token_urlsafe(16)
+    expires = now + SESSION_TTL
+    sessions[sid] = {"user": user, "expires": expires}
+    return f"{sid}.{expires}.{sign_session(sid, expires, user['username'])}"
+
+
+def resume_session(token):
+    """驗證 token，回傳對應的 user_data；無效或過期回傳 None"""
+    try:
+        sid, expires, signature = str(token).split(".")
+    except ValueError:
+        return None
+    entry = sessions.get(sid)
+    if not entry or str(entry["expires"]) != expires or entry["expires"] <= time.time():
+        return None
+    if not hmac.compare_digest(signature, sign_session(sid, entry["expires"], entry["user"]['username'])):
+        return None
+    return entry["user"]
+
+
+def revoke_session(token):
+    sessions.pop(str(token).split(".")[0], None)
+
+
+def take_over_login(username, conn):
+    """登記 username 目前的連線；已有其他連線時關閉舊的 (多半已半開 half-open)，由新連線接手"""
+    old_conn = online_users.get(username)
+    if old_conn is not None and old_conn is not conn:
+        old_conn.close()
+    online_users[username] = conn
+
+
+def user_rooms(username):
+    """使用者所在的房間與其狀態 (RESUME 時交給 Client 接續等待)"""
+    return {rid: room_status(room) for rid, room in rooms.items() if username in room['players']}
+
+
+def invalidate_catalog():
+    catalog["version"] += 1
+    catalog["entries"].clear()
+
+
+async def cached_query(key, func, *args):
+    """回傳 (version, 結果)；快取沒有時在 db_executor 查詢，同一個 key 同時只查一次"""
+    entries = catalog["entries"]
+    if key in entries:
+        return catalog["version"], entries[key]
+    version, loading = catalog["version"], catalog["loading"].get(key)
+    if loading is None or loading[0] != version:
+        loading = catalog["loading"][key] = (version, asyncio.ensure_future(run_blocking(db_executor, func, *args)))
+    try:
+        result = await asyncio.shield(loading[1])
+    finally:
+        if catalog["loading"].get(key) is loading:
+            del catalog["loading"][key]
+    # 查詢期間若有人失效了快取，這份結果只回給這次的請求，不存起來
+    if catalog["version"] == version:
+        if len(entries) >= CATALOG_CACHE_SIZE:
+            entries.pop(next(iter(entries)))
+        entries[key] = result
+    return version, result
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def cached_package(digest, path):
+    """
+    回傳熱門版本 client.zip 的內容 (bytes)，超過 PACKAGE_CACHE_ITEM_MAX 或舊資料 (沒有 digest) 回傳 None
+    artifact 建立後不再變動，以 digest 為 key 不需要失效；同一個版本同時只從磁碟讀一次
+    """
+    if not digest:
+        return None
+    entries = package_cache["entries"]
+    if digest in entries:
+        entries.move_to_end(digest)
+        return entries[digest]
+    if os.path.getsize(path) > PACKAGE_CACHE_ITEM_MAX:
+        return None
+    loading = package_cache["loading"].get(digest)
+    if loading is None:
+        loading = package_cache["loading"][digest] = asyncio.ensure_future(run_blocking(io_executor, read_file, path))
+    try:
+        data = await asyncio.shield(loading)
+    finally:
+        if package_cache["loading"].get(digest) is loading:
+            del package_cache["loading"][digest]
+    if digest not in entries:
+        entries[digest] = data
+        package_cache["bytes"] += len(data)
+        while package_cache["bytes"] > PACKAGE_CACHE_SIZE:
+            _, evicted = entries.popitem(last=False)
+            package_cache["bytes"] -= len(evicted)
+    return data
+
+
+async def send_package(conn, path, data, raw, offset=0):
+    """送出 DOWNLOAD 從 offset 起的檔案內容 (呼叫端持有 write_lock)：data 為快取中的內容，None 表示直接從檔案送"""
+    if data is not None:
+        # 一次只交一段給 transport 並 drain：送不完的部分會被複製進每條連線自己的緩衝區，
+        # 整包交出去等於每個下載者各持有一份，快取的記憶體上限就失去意義
+        view = memoryview(data)[offset:]
+        for start in range(0, len(view), DOWNLOAD_CHUNK):
+            if raw:
+                conn.write_raw(view[start:start + DOWNLOAD_CHUNK])
+            else:
+                conn.write_frame(view[start:start + DOWNLOAD_CHUNK])
+            await conn.drain()
+    elif raw:
+        with open(path, "rb") as f:
+            await conn.sendfile(f, offset)
+    else:
+        await send_file(conn, path, offset)
+
+
+def download_offset(request, sha256, size):
+    """
+    DOWNLOAD 續傳的起點；offset 不合法 (非整數或超出 0..size) 時回傳 None
+    先比對 if_sha256 再檢查範圍 (同 HTTP If-Range)：舊版本較大的暫存檔續傳新版本時要從頭送，而不是回報 offset 超出範圍
+    """
+    offset = request.get("offset") or 0
+    if request.get("if_sha256") not in (None, sha256):
+        return 0
+    if isinstance(offset, bool) or not isinstance(offset, int) or not 0 <= offset <= size:
+        return None
+    return offset
+
+
+async def find_game(name):
+    _, game_info = await cached_query(("game", name), get_game_info, name)
+    return game_info
 
-def handle_client(conn, addr):
+
+async def write_succeeded(label, future):
+    """等一筆資料庫寫入完成；寫入失敗 (已由寫入執行緒整筆撤銷) 時記錄錯誤並回傳 False"""
+    try:
+        return await asyncio.wrap_future(future)
+    except Exception as e:
+        print(f"[DB Error] {label}: {e}")
+        return False
+
+
+def log_play_recorded(future):
+    if future.exception():
+        print(f"[DB Error] 遊玩紀錄寫入失敗: {future.exception()}", flush=True)
+    else:
+        print(f"[Debug] 遊玩紀錄寫入完成", flush=True)
+
+
+def page_limit(request):
+    try:
+        return max(1, min(int(request.get("limit") or PAGE_SIZE), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+
+
+def active_upload_jobs(author):
+    return [j for j in upload_jobs.values() if j["author"] == author and j["state"] in ("receiving", "queued", "processing")]
+
+
+def new_upload_job(action, game_name, author):
+    global upload_job_counter
+    now = time.time()
+    for job_id in [k for k, j in upload_jobs.items() if j.get("finished_at", now) < now - UPLOAD_JOB_TTL]:
+        del upload_jobs[job_id]
+    upload_job_counter += 1
+    job = {"job_id": upload_job_counter, "action": action, "game_name": game_name, "author": author,
+           "state": "receiving", "message": "", "created_at": now}
+    upload_jobs[job["job_id"]] = job
+    return job
+
+
+def finish_upload_job(job, state, message):
+    job["state"] = state
+    job["message"] = message
+    job["finished_at"] = time.time()
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def process_upload_job(job, request, staging_path):
+    """在背景把上傳檔存進 artifact store，完成後才把資料庫指向新的 digest；同一款遊戲的工作依序執行"""
+    game_name = job["game_name"]
+    lock = game_package_locks.setdefault(game_name, asyncio.Lock())
+    try:
+        async with lock:
+            job["state"] = "processing"
+            missing_msg = "上傳的遊戲缺少 client 資料夾" if job["action"] == "UPLOAD" else "更新包中缺少 client 資料夾"
+            await run_blocking(package_executor, extract_game_package, staging_path, job["digest"], missing_msg)
+
+            # 寫入資料庫 (符合 PDF Step 6)，我們將 zip 檔名作為路徑存入
+            if job["action"] == "UPLOAD":
+                if not await write_succeeded("Add Game", add_game(game_name, request.get("version"), request.get("description"),
+                                                                      request.get("filename"), job["author"], request.get("max_players", 2), job["digest"])):
+                    raise Exception("資料庫寫入失敗")
+                message = f"遊戲 {game_name} 上架成功"
+            else:
+                # 舊版本的檔案原封不動，正在玩的房間與下載中的 Client 不受影響
+                if not await write_succeeded("Update Game", update_game_version_db(game_name, job["author"], request['version'], request['description'],
+                                                                                       request.get('max_players', 2), job["digest"])):
+                    raise Exception("資料庫寫入失敗")
+                message = f"遊戲 {game_name} 已更新至 v{request['version']}"
+            invalidate_catalog()
+        finish_upload_job(job, "done", message)
+    except Exception as e:
+        finish_upload_job(job, "failed", f"處理失敗: {e}")
+    finally:
+        await run_blocking(io_executor, remove_file, staging_path)
+    print(f"[上傳工作 #{job['job_id']}] {job['state']}: {job['message']}")
+    await collect_artifacts()
+
+
+def upload_job_status(job):
+    return {k: job[k] for k in ("job_id", "action", "game_name", "state", "message")}
+
+
+def with_req_id(response, request):
+    """回覆帶上請求的 req_id，讓 Client 能把亂序的回覆對回請求"""
+    if "req_id" in request:
+        response["req_id"] = request["req_id"]
+    return response
+
+
+async def process_request(session, request):
     """
-    處理單一 Client 的所有請求 (執行緒函式)
+    處理單一請求並回傳回覆；回傳 None 表示已在函式內自行回覆 (例如 DOWNLOAD)
     """
     global room_id_counter
-    print(f"[連線] 新連線來自: {addr}")
-    
-    user_data = None  # 用來紀錄目前連線的使用者是誰 (登入後才有值)
+    conn = session.conn
+    user_data = session.user_data
+
+    action = request.get("action")
+    response = {"status": "FAIL", "message": "Unknown action"}
+
+    # --- 2. 根據 action 決定要做什麼 (路由分發) ---
+
+    # === 編碼協商：挑選雙方都支援的 codec 與壓縮方式，之後的回覆改用該設定 ===
+    if action == "HELLO":
+        conn.codec = choose_codec(request.get("codecs"))
+        compression = choose_compression(request.get("compress"))
+        conn.compress = compression is not None
+        response = {"status": "SUCCESS", "codec": conn.codec, "compress": compression}
+
+    # === 功能 A: 註冊 ===
+    elif action == "REGISTER":
+        username = request.get("username")
+        password = request.get("password")
+        role = request.get("role", "player") # 預設是玩家
+
+        if await asyncio.wrap_future(register_user(username, password, role)):
+            response = {"status": "SUCCESS", "message": "註冊成功"}
+        else:
+            response = {"status": "FAIL", "message": "帳號已存在"}
+
+    # === 功能 B: 登入 ===
+    elif action == "LOGIN":
+        username = request.get("username")
+        password = request.get("password")
+
+        user = await run_blocking(db_executor, login_check, username, password)
+        if not user:
+            response = {"status": "FAIL", "message": "帳號或密碼錯誤"}
+        else:
+            # 密碼正確就由新連線接手 (與 RESUME 相同)，Client 重開後遺失 token 也不會被半開的舊連線鎖住
+            take_over_login(username, conn)
+            session.user_data = user_data = user
+            response = {
+                "status": "SUCCESS",
+                "message": "登入成功",
+                "user": {
+                    "username": user['username'],
+                    "role": user['role']
+                },
+                "token": issue_session(user)  # 斷線後可用 RESUME 直接恢復，不必重新輸入帳密
+            }
+
+    # === 斷線重連：用 LOGIN 取得的 token 恢復登入狀態 (不查 DB)，房間成員身分保留 ===
+    elif action == "RESUME":
+        user = resume_session(request.get("token"))
+        if not user:
+            response = {"status": "FAIL", "message": "登入已失效，請重新登入"}
+        else:
+            username = user['username']
+            take_over_login(username, conn)
+            session.user_data = user_data = user
+            my_rooms = user_rooms(username)
+            if request.get("subscribe"):
+                for rid, status in my_rooms.items():
+                    if not status.get("game_start"):
+                        subscribe_room(session, rid)
+            response = {
+                "status": "SUCCESS",
+                "user": {"username": username, "role": user['role']},
+                "rooms": my_rooms
+            }
+
+    elif action == "LOGOUT":
+        revoke_session(request.get("token", ""))
+        if user_data and online_users.get(user_data['username']) is conn:
+            online_users.pop(user_data['username'], None)
+        session.user_data = None
+        response = {"status": "SUCCESS", "message": "已登出"}
+
+
+    elif action in ("UPLOAD", "UPDATE_GAME"):
+        # 收完檔案就回覆；解壓、檢查與打包排進 package_executor，由 UPLOAD_STATUS 查詢進度
+        if not user_data or user_data['role'] != 'developer':
+            return {"status": "FAIL", "message": "權限不足"}
+
+        game_name = request.get("game_name")
+        author = user_data['username']
+        if action == "UPLOAD" and (await find_game(game_name) or
+                                   any(j["game_name"] == game_name and j["state"] not in ("done", "failed") for j in upload_jobs.values())):
+            return {"status": "FAIL", "message": f"遊戲名稱 {game_name} 已存在"}
+        if len(active_upload_jobs(author)) >= MAX_UPLOAD_JOBS_PER_DEVELOPER:
+            return {"status": "FAIL", "message": "上傳工作過多，請等待先前的上傳處理完成"}
+
+        # 1. 準備接收檔案 (每個工作各自一個暫存 zip，彼此不會互相覆蓋)
+        job = new_upload_job(action, game_name, author)
+        staging_path = os.path.join(INCOMING_DIR, f"{job['job_id']}-{secrets.token_hex(4)}.zip")
+        await conn.send_json({"status": "READY", "job_id": job["job_id"]})
+
+        try:
+            job["digest"] = await receive_file(conn, staging_path, request)
+        except Exception as e:
+            finish_upload_job(job, "failed", f"上傳中斷: {e}")
+            return {"status": "FAIL", "message": job["message"], "job_id": job["job_id"]}
+
+        # 2. 背景處理
+        job["state"] = "queued"
+        task = asyncio.ensure_future(process_upload_job(job, request, staging_path))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        response = {"status": "SUCCESS", "message": f"已收到 {game_name}，處理中 (工作 #{job['job_id']})",
+                    "job_id": job["job_id"], "state": job["state"]}
+
+    elif action == "UPLOAD_STATUS":
+        if not user_data:
+            return {"status": "FAIL", "message": "請先登入"}
+        job = upload_jobs.get(request.get("job_id"))
+        if request.get("job_id") is None:
+            jobs = [upload_job_status(j) for j in upload_jobs.values() if j["author"] == user_data['username']]
+            response = {"status": "SUCCESS", "jobs": jobs}
+        elif not job or job["author"] != user_data['username']:
+            response = {"status": "FAIL", "message": "找不到該上傳工作"}
+        else:
+            response = {"status": "SUCCESS", "job": upload_job_status(job)}
+
+    elif action == "LIST_MY_GAMES":
+        # 取得該開發者的遊戲 (符合 PDF Step 7)
+        my_games = await run_blocking(db_executor, get_games_by_author, user_data['username'])
+        response = {"status": "SUCCESS", "games": my_games}
+
+    elif action == "DELETE_GAME":
+        g_name = request['game_name']
+        if await write_succeeded("Delete Game", delete_game_db(g_name, user_data['username'])):
+            invalidate_catalog()
+            # 清理實體檔案，避免下架後還能被搜到 (舊路徑直接刪除，artifact store 中的版本等房間都結束後才回收)
+            await run_blocking(io_executor, remove_game_files, g_name)
+            await collect_artifacts()
+            response = {"status": "SUCCESS", "message": "下架成功"}
+        else:
+            response = {"status": "FAIL", "message": "下架失敗"}
+
+    elif action == "LIST_GAMES":
+        # 結合平均評分與評論數 (P1 要求)，以 after 游標分頁；Client 手上的版本還是最新的就只回 NOT_MODIFIED
+        sort = request.get("sort", "name")
+        author = request.get("author")
+        after = request.get("after")
+        limit = page_limit(request)
+        if sort not in GAME_SORTS:
+            response = {"status": "FAIL", "message": f"不支援的排序方式: {sort}"}
+        elif request.get("if_version") == catalog["version"]:
+            response = {"status": "NOT_MODIFIED", "version": catalog["version"]}
+        else:
+            key = ("games", sort, author, tuple(after) if isinstance(after, list) else after, limit)
+            try:
+                version, (games, next_cursor) = await cached_query(key, list_games_page, sort, author, after, limit)
+                response = {"status": "SUCCESS", "games": games, "next": next_cursor, "version": version}
+            except (ValueError, TypeError):
+                response = {"status": "FAIL", "message": "分頁游標錯誤"}
+
+    elif action == "SEARCH_GAMES":
+        # 全文搜尋 (名稱、簡介、作者)，依相關度排序並分頁；結果同樣走目錄快取
+        query = str(request.get("query") or "").strip()
+        after = request.get("after")
+        limit = page_limit(request)
+        try:
+            version, (games, next_cursor) = await cached_query(("search", query, after, limit), search_games, query, after, limit)
+            response = {"status": "SUCCESS", "games": games, "next": next_cursor, "version": version}
+        except (ValueError, TypeError):
+            response = {"status": "FAIL", "message": "分頁游標錯誤"}
+
+    elif action == "DOWNLOAD":
+        # transfer = "raw" 的 Client：回覆後直接接檔案內容 (記憶體快取或 sendfile)；舊版 Client 照舊切成 frame
+        game_info = await find_game(request['game_id'])
+        digest = game_info and game_info['digest']
+        _, zip_path = game_paths(request['game_id'], digest)
+        # 續傳：帶 offset 只送剩下的部分；if_sha256 與目前的檔案不同 (版本已更新) 時改從頭送
+        if os.path.exists(zip_path):
+            data = await cached_package(digest, zip_path)
+            stat = os.stat(zip_path)
+            size = len(data) if data is not None else stat.st_size
+            sha256 = await run_blocking(io_executor, package_sha256, zip_path, stat.st_mtime_ns, stat.st_size)
+            offset = download_offset(request, sha256, size)
+            if offset is None:
+                return {"status": "FAIL", "message": f"offset 超出範圍: {request.get('offset')}"}
+            raw = request.get("transfer") == TRANSFER_RAW
+            reply = {"status": "SUCCESS", "size": size, "offset": offset, "sha256": sha256}
+            if raw:
+                reply["transfer"] = TRANSFER_RAW
+            # 檔案內容緊接在回覆之後，整段傳輸期間獨佔寫入端，避免其他回覆插進來
+            async with conn.write_lock:
+                conn.write_json(with_req_id(reply, request))
+                await send_package(conn, zip_path, data, raw, offset)
+            return None
+        else: response = {"status": "FAIL", "message": "檔案不存在"}
+
+    elif action == "SYNC_GAME":
+        # 差異更新：Client 送上本地 manifest ({路徑: sha256})，只回傳有變動或新增的檔案與要刪除的路徑
+        # 帶 room_id 時以房間釘住的版本為準，與房間的遊戲 Server 一致
+        game_id = request.get('game_id')
+        room = rooms.get(request.get('room_id'))
+        if room and room['game_id'] == game_id:
+            version, digest = room['version'], room.get('digest')
+        else:
+            game_info = await find_game(game_id)
+            version, digest = (game_info['version'], game_info['digest']) if game_info else (None, None)
+        local = request.get('manifest')
+        if not digest or not isinstance(local, dict):
+            # 舊資料沒有 manifest，Client 改用 DOWNLOAD 下載完整 zip
+            return {"status": "FAIL", "message": "此版本不支援差異更新"}
+        manifest = await run_blocking(io_executor, load_manifest, digest)
+        changed = [dict(path=path, **meta) for path, meta in manifest.items() if local.get(path) != meta['sha256']]
+        deleted = [path for path in local if path not in manifest]
+        if request.get("dry_run"):
+            # 只列出差異不送內容：Client 可先從本機快取補上，再用實際的 manifest 同步剩下的檔案
+            return {"status": "SUCCESS", "version": version, "files": changed, "delete": deleted,
+                    "size": sum(f['size'] for f in changed), "dry_run": True}
+        client_dir = os.path.join(STORE_DIR, digest, "package", "client")
+        async with conn.write_lock:
+            conn.write_json(with_req_id({"status": "SUCCESS", "version": version, "files": changed, "delete": deleted,
+                                         "size": sum(f['size'] for f in changed)}, request))
+            # 檔案內容依 files 的順序緊接在回覆之後，每個檔案各自切成 frame，不會與下一個檔案共用 frame
+            for f in changed:
+                await send_file(conn, os.path.join(client_dir, *f['path'].split("/")))
+        return None
+
+    # --- 4. 房間管理與遊玩紀錄 (RQU-5, 6) ---
+    elif action == "CREATE_ROOM":
+        gid = request['game_id']
+        game_info = await find_game(gid)
+
+        if not game_info:
+            response = {"status": "FAIL", "message": "找不到該遊戲資訊"}
+        else:
+            rid = str(room_id_counter)
+            room_id_counter += 1
+            rooms[rid] = {
+                "game_id": gid, 
+                "version": game_info['version'], 
+                "digest": game_info['digest'],  # 釘住建立房間當下的版本，之後的更新不影響這個房間
+                "players": [user_data['username']], 
+                "max_players": game_info['max_players'], # 記錄此房間的人數上限
+                "status": "WAITING"
+            }
+            if request.get("subscribe"):
+                subscribe_room(session, rid)
+            response = {"status": "SUCCESS", "room_id": rid, "version": game_info['version']}
+
+    elif action == "LIST_ROOMS":
+        r_list = [{"room_id": k, "game_id": v["game_id"], "player_count": len(v["players"]), "max_players":v["max_players"], "status": v["status"]} for k, v in rooms.items()]
+        response = {"status": "SUCCESS", "rooms": r_list}
+
+    elif action == "JOIN_ROOM":
+        rid = request.get('room_id')
+        room = rooms.get(rid)
+        if not room or room['status'] != "WAITING":
+            response = {"status": "FAIL", "message": "房間無法加入"}
+        elif len(room['players']) >= room['max_players']:
+            response = {"status": "FAIL", "message": "房間已滿"}
+        else:
+            room['players'].append(user_data['username'])
+            if request.get("subscribe"):
+                subscribe_room(session, rid)
+            publish_room_event(rid, "player_joined", players=list(room['players']), max_players=room['max_players'])
+
+            # 檢查是否達到啟動條件 (先改狀態再 await，避免其他連線同時擠進來)
+            if len(room['players']) == room['max_players']:
+                room['status'] = "PLAYING"
+                publish_room_event(rid, "game_starting", game_id=room['game_id'])
+                print(f"[Debug] 遊戲達到上限，準備紀錄遊玩歷史: {room['players']} 正在玩 {room['game_id']}", flush=True)
+
+                # 遊玩紀錄交給寫入執行緒即可，不必等 commit 才啟動遊戲 (之後的 SUBMIT_REVIEW 排在它後面)
+                record_play(list(room['players']), room['game_id']).add_done_callback(log_play_recorded)
+                server_dir, _ = game_paths(room['game_id'], room['digest'])
+                g_port, room['process'] = await run_blocking(io_executor, start_game_process, server_dir, rid)
+                room['game_port'] = g_port
+                ready = room_status(room)
+                ready.pop("status")
+                publish_room_event(rid, "game_ready", **ready)
+                # 遊戲已開始，這個房間不會再有事件
+                for sub in list(room_subscribers.get(rid, ())):
+                    unsubscribe_room(sub, rid)
+                response = {"status": "SUCCESS", "game_start": True}
+            else:
+                response = {"status": "SUCCESS", "game_start": False}
+
+    elif action == "CHECK_ROOM":
+        response = room_status(rooms.get(request.get('room_id')))
+
+    # === 訂閱房間事件：player_joined / game_starting / game_ready 會直接推播到這條連線 ===
+    elif action == "SUBSCRIBE_ROOM":
+        rid = request.get('room_id')
+        room = rooms.get(rid)
+        if not room:
+            response = {"status": "FAIL", "message": "房間不存在"}
+        else:
+            if not room.get("game_port"):
+                subscribe_room(session, rid)
+            response = room_status(room)  # 附上目前狀態，訂閱前發生的事不會漏掉
+
+    elif action == "UNSUBSCRIBE_ROOM":
+        unsubscribe_room(session, request.get('room_id'))
+        response = {"status": "SUCCESS"}
+
+    # --- 5. 評價系統 (RQU-6) ---
+    elif action == "SUBMIT_REVIEW":
+        status, msg = await asyncio.wrap_future(add_review(request['game_name'], user_data['username'], request['rating'], request['comment']))
+        if status:
+            invalidate_catalog()
+        response = {"status": "SUCCESS" if status else "FAIL", "message": msg}
+
+    elif action == "GET_REVIEWS":
+        try:
+            reviews, next_cursor = await run_blocking(db_executor, get_game_reviews, request['game_name'],
+                                                      request.get("after"), page_limit(request))
+            response = {"status": "SUCCESS", "reviews": reviews, "next": next_cursor}
+        except (ValueError, TypeError):
+            response = {"status": "FAIL", "message": "分頁游標錯誤"}
+
+
+    return response
+
+
+async def respond(session, request):
+    response = await process_request(session, request)
+    if response is not None:
+        await session.conn.send_json(with_req_id(response, request))
+
+
+async def respond_concurrently(session, request):
+    try:
+        await respond(session, request)
+    except Exception as e:
+        # 與逐一處理時相同：處理失敗就結束這條連線
+        print(f"[異常] {session.addr} 處理 {request.get('action')} 時發生錯誤: {e}")
+        session.conn.close()
+    finally:
+        session.slots.release()
+
+
+async def handle_client(reader, writer):
+    """
+    處理單一 Client 的所有請求 (coroutine，每條連線不再佔用一個 OS 執行緒)
+    - 沒有 req_id 的請求依序處理，與舊版 Client 的一問一答相容
+    - 帶 req_id 的請求可並行處理，回覆可能亂序，由 Client 依 req_id 配對
+    """
+    global active_connections
+    conn = AsyncFramedConnection(reader, writer, max_message=MAX_REQUEST_LEN)
+    addr = writer.get_extra_info("peername")
+    session = ClientSession(conn, addr)
+    active_connections += 1
+    print(f"[連線] 新連線來自: {addr} (目前連線數: {active_connections})")
 
     try:
         while True:
             # 1. 等待並接收 Client 傳來的 JSON 指令
-            request = recv_json(conn)
+            request = await conn.recv_json()
             
             # 如果收到空資料或連線斷開
             if not request:
                 break
                 
             print(f"[收到指令] {addr}: {request}")
-            
-            action = request.get("action")
-            response = {"status": "FAIL", "message": "Unknown action"}
-
-            # --- 2. 根據 action 決定要做什麼 (路由分發) ---
-            
-            # === 功能 A: 註冊 ===
-            if action == "REGISTER":
-                username = request.get("username")
-                password = request.get("password")
-                role = request.get("role", "player") # 預設是玩家
-                
-                if register_user(username, password, role):
-                    response = {"status": "SUCCESS", "message": "註冊成功"}
-                else:
-                    response = {"status": "FAIL", "message": "帳號已存在"}
 
-            # === 功能 B: 登入 ===
-            elif action == "LOGIN":
-                username = request.get("username")
-                password = request.get("password")
-
-                user = login_check(username, password)
-                if not user:
-                    response = {"status": "FAIL", "message": "帳號或密碼錯誤"}
-                else:
-                    with online_users_lock:
-                        if username in online_users:
-                            response = {
-                                "status": "FAIL",
-                                "message": "此帳號已在其他地方登入"
-                            }
-                        else:
-                            user_data = user
-                            online_users[username] = conn
-                            response = {
-                                "status": "SUCCESS",
-                                "message": "登入成功",
-                                "user": {
-                                    "username": user['username'],
-                                    "role": user['role']
-                                }
-                            }
-
-
-            elif action == "UPLOAD":
-                if not user_data or user_data['role'] != 'developer':
-                    send_json(conn, {"status": "FAIL", "message": "權限不足"})
-                    continue
-
-                game_name = request.get("game_name")
-                version = request.get("version")
-                desc = request.get("description")
-                filename = request.get("filename")
-                file_size = request.get("size")
-                max_players = request.get("max_players", 2)
-
-                # 1. 準備接收檔案
-                zip_path = os.path.join(current_dir, "uploaded_game", filename)
-                send_json(conn, {"status": "READY"})
-                
-                try:
-                    with open(zip_path, "wb") as f:
-                        received = 0
-                        while received < file_size:
-                            chunk = recv_frame(conn)
-                            if not chunk: break
-                            f.write(chunk)
-                            received += len(chunk)
-
-                    extract_path = zip_path.replace(".zip", "")
-                    if os.path.exists(extract_path): shutil.rmtree(extract_path)
-                    with zipfile.ZipFile(zip_path, 'r') as zf:
-                        zf.extractall(extract_path)
-
-                    client_dir = os.path.join(extract_path, "client")
-                    player_zip = os.path.join(current_dir, "uploaded_game", f"{game_name}.zip")
-
-                    if not os.path.isdir(client_dir):
-                        raise Exception("上傳的遊戲缺少 client 資料夾")
-
-                    shutil.make_archive(
-                        player_zip.replace(".zip", ""),
-                        "zip",
-                        client_dir
-                    )
-                        
-                    # 2. 寫入資料庫 (符合 PDF Step 6)
-                    # 我們將 zip 檔名作為路徑存入
-                    if add_game(game_name, version, desc, filename, user_data['username'], max_players):
-                        response = {"status": "SUCCESS", "message": f"遊戲 {game_name} 上架成功"}
-                    else:
-                        response = {"status": "FAIL", "message": "資料庫寫入失敗"}
-                except Exception as e:
-                    response = {"status": "FAIL", "message": f"上傳中斷: {e}"}
-
-            elif action == "LIST_MY_GAMES":
-                # 取得該開發者的遊戲 (符合 PDF Step 7)
-                my_games = get_games_by_author(user_data['username'])
-                response = {"status": "SUCCESS", "games": my_games}
-
-            elif action == "UPDATE_GAME":
-                # 1. 接收新檔案並覆蓋舊檔案
-                send_json(conn, {"status": "READY"})
-                game_name = request['game_name'] # 確保有拿到 game_name
-                zip_name = request['filename']
-                zip_path = os.path.join(current_dir, "uploaded_game", zip_name)
-                
-                try:
-                    with open(zip_path, "wb") as f:
-                        received = 0
-                        while received < request['size']:
-                            chunk = recv_frame(conn)
-                            if not chunk: break
-                            f.write(chunk)
-                            received += len(chunk)
-                    
-                    # 2. 自動解壓覆蓋
-                    extract_path = zip_path.replace(".zip", "")
-                    if os.path.exists(extract_path):
-                        shutil.rmtree(extract_path)
-                    with zipfile.ZipFile(zip_path, 'r') as z:
-                        z.extractall(extract_path)
-
-                    # --- 關鍵修正：重新產生玩家下載專用的 client-only zip ---
-                    client_dir = os.path.join(extract_path, "client")
-                    # 這是 DOWNLOAD action 會讀取的路徑: f"{game_id}.zip"
-                    player_zip = os.path.join(current_dir, "uploaded_game", f"{game_name}.zip")
-
-                    if not os.path.isdir(client_dir):
-                        raise Exception("更新包中缺少 client 資料夾")
-
-                    # 重新打包，確保結構與 UPLOAD 時一致
-                    shutil.make_archive(
-                        player_zip.replace(".zip", ""),
-                        "zip",
-                        client_dir
-                    )
-                    # ---------------------------------------------------
-
-                    # 3. 更新資料庫
-                    from db_server import update_game_version_db
-                    update_game_version_db(game_name, user_data['username'], request['version'], request['description'], request.get('max_players', 2))
-                    
-                    response = {"status": "SUCCESS", "message": f"遊戲 {game_name} 已更新至 v{request['version']}"}
-                    
-                except Exception as e:
-                    response = {"status": "FAIL", "message": f"更新失敗: {e}"}
-
-            elif action == "DELETE_GAME":
-                g_name = request['game_name']
-                from db_server import delete_game_db
-                if delete_game_db(g_name, user_data['username']):
-                    # 同步清理實體檔案，避免下架後還能被搜到
-                    zip_path = os.path.join(current_dir, "uploaded_game", f"{g_name}.zip")
-                    folder_path = os.path.join(current_dir, "uploaded_game", g_name)
-                    if os.path.exists(zip_path): os.remove(zip_path)
-                    if os.path.exists(folder_path): shutil.rmtree(folder_path)
-                    response = {"status": "SUCCESS", "message": "下架成功"}
-                else:
-                    response = {"status": "FAIL", "message": "下架失敗"}
-
-            elif action == "LIST_GAMES":
-                conn_db = get_db_connection()
-                # 結合平均評分與評論數 (P1 要求)
-                query = '''
-                    SELECT g.*, AVG(r.rating) as avg_rating, COUNT(r.id) as review_count
-                    FROM games g LEFT JOIN reviews r ON g.name = r.game_name
-                    GROUP BY g.name
-                '''
-                games = [dict(row) for row in conn_db.execute(query).fetchall()]
-                conn_db.close()
-                response = {"status": "SUCCESS", "games": games}
-
-            elif action == "DOWNLOAD":
-                zip_path = os.path.join(current_dir, "uploaded_game", f"{request['game_id']}.zip")
-                if os.path.exists(zip_path):
-                    send_json(conn, {"status": "SUCCESS", "size": os.path.getsize(zip_path)})
-                    with open(zip_path, "rb") as f:
-                        while chunk := f.read(60000): send_frame(conn, chunk)
-                    continue 
-                else: response = {"status": "FAIL", "message": "檔案不存在"}
-
-            # --- 4. 房間管理與遊玩紀錄 (RQU-5, 6) ---
-            elif action == "CREATE_ROOM":
-                global room_id_counter
-                rid = str(room_id_counter)
-                room_id_counter += 1
-                gid = request['game_id']
-                conn_db = get_db_connection()
-                game_info = conn_db.execute("SELECT version, max_players FROM games WHERE name = ?", (gid,)).fetchone()
-                conn_db.close()
-
-                if not game_info:
-                    response = {"status": "FAIL", "message": "找不到該遊戲資訊"}
-                else:
-                    cur_ver = game_info['version']
-                    max_p = game_info['max_players']
-
-                with rooms_lock:
-                    rooms[rid] = {
-                        "game_id": gid, 
-                        "version": cur_ver, 
-                        "players": [user_data['username']], 
-                        "max_players": max_p, # 記錄此房間的人數上限
-                        "status": "WAITING"
-                    }
-                response = {"status": "SUCCESS", "room_id": rid}
-
-            elif action == "LIST_ROOMS":
-                with rooms_lock:
-                    r_list = [{"room_id": k, "game_id": v["game_id"], "player_count": len(v["players"]), "max_players":v["max_players"], "status": v["status"]} for k, v in rooms.items()]
-                response = {"status": "SUCCESS", "rooms": r_list}
-
-            elif action == "JOIN_ROOM":
-                rid = request.get('room_id')
-                with rooms_lock:
-                    room = rooms.get(rid)
-                    if not room or room['status'] != "WAITING":
-                        response = {"status": "FAIL", "message": "房間無法加入"}
-                    elif len(room['players']) >= room['max_players']:
-                        response = {"status": "FAIL", "message": "房間已滿"}
-                    else:
-                        room['players'].append(user_data['username'])
-
-                        # 檢查是否達到啟動條件
-                        if len(room['players']) == room['max_players']:
-                            room['status'] = "PLAYING"
-                            print(f"[Debug] 遊戲達到上限，準備紀錄遊玩歷史: {room['players']} 正在玩 {room['game_id']}", flush=True) # 新增這行
-    
-                            for player_name in room['players']:
-                                record_play(player_name, room['game_id']) 
-                            
-                            print(f"[Debug] 遊玩紀錄寫入完成", flush=True) # 新增這行
-                            g_port = start_game_process(room['game_id'], rid)
-                            room['game_port'] = g_port
-                            response = {"status": "SUCCESS", "game_start": True}
-                        else:
-                            response = {"status": "SUCCESS", "game_start": False}
-
-            elif action == "CHECK_ROOM":
-                rid = request.get('room_id')
-                with rooms_lock:
-                    room = rooms.get(rid)
-
-                    if room and room.get("game_port"):
-                        response = {
-                            "status": "SUCCESS",
-                            "game_start": True,
-                            "game_id": room['game_id'],
-                            "version": room.get('version'),
-                            "game_ip": SERVER_IP,
-                            "game_port": room['game_port']
-                        }
-                    else:
-                        response = {
-                            "status": "SUCCESS",
-                            "game_start": False,
-                            "players": room['players'] if room else [],
-                            "max_players": room['max_players'] if room else 2
-                        }
-
-            # --- 5. 評價系統 (RQU-6) ---
-            elif action == "SUBMIT_REVIEW":
-                status, msg = add_review(request['game_name'], user_data['username'], request['rating'], request['comment'])
-                response = {"status": "SUCCESS" if status else "FAIL", "message": msg}
-
-            elif action == "GET_REVIEWS":
-                response = {"status": "SUCCESS", "reviews": get_game_reviews(request['game_name'])}
-
-            send_json(conn, response)
+            if "req_id" in request and request.get("action") not in STREAM_ACTIONS:
+                await session.slots.acquire()  # 限制單一連線同時處理的請求數
+                task = asyncio.ensure_future(respond_concurrently(session, request))
+                session.inflight.add(task)
+                task.add_done_callback(session.inflight.discard)
+            else:
+                # 需要獨佔連線收送檔案的請求，先等先前並行中的請求都回覆完
+                if session.inflight:
+                    await asyncio.wait(set(session.inflight))
+                await respond(session, request)
 
+    except asyncio.IncompleteReadError:
+        pass  # Client 正常斷線
     except Exception as e:
         print(f"[異常] {addr} 發生錯誤: {e}")
     finally:
-        if user_data:
-            with online_users_lock:
-                online_users.pop(user_data['username'], None)
+        active_connections -= 1
+        for task in list(session.inflight):
+            task.cancel()
+        for rid in list(session.subscriptions):
+            unsubscribe_room(session, rid)
+        user_data = session.user_data
+        if user_data and online_users.get(user_data['username']) is conn:
+            online_users.pop(user_data['username'], None)
         print(f"[斷線] {addr} (使用者: {user_data['username'] if user_data else '未登入'})")
         conn.close()
 
@@ -370,42 +996,55 @@ def handle_upload_connection(conn):
         handle_upload(conn, game_name)
 
 
+def raise_fd_limit():
+    """每條閒置連線佔用一個 fd，盡量把 soft limit 拉到 hard limit (Windows 沒有 resource 模組)"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def serve():
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT,
+        reuse_address=True,  # 允許 Port 重複使用 (避免重啟 Server 時報錯 "Address already in use")
+        backlog=LISTEN_BACKLOG
+    )
+    background_tasks.add(asyncio.ensure_future(artifact_gc_loop()))
+    print(f"[啟動] Server 正在監聽 {HOST}:{PORT}")
+    print("[等待連線] 按 Ctrl+C 關閉 Server...")
+    async with server:
+        await server.serve_forever()
+
+
 def start_server():
     """
-    Server 啟動主迴圈
+    Server 啟動主迴圈 (單一 event loop 服務所有連線)
     """
-    required_dir = [os.path.join(current_dir, "uploaded_game")]
+    required_dir = [os.path.join(current_dir, "uploaded_game"), INCOMING_DIR, STORE_DIR]
     for d in required_dir :
         if not os.path.exists(d) :
             print(f"[系統] 自動建立遺失的資料夾: {d}")
             os.makedirs(d)
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # 允許 Port 重複使用 (避免重啟 Server 時報錯 "Address already in use")
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
-    try:
-        server.bind((HOST, PORT))
-        server.listen()
-        print(f"[啟動] Server 正在監聽 {HOST}:{PORT}")
-        print("[等待連線] 按 Ctrl+C 關閉 Server...")
-
-        while True:
-            # 接受新連線
-            conn, addr = server.accept()
-            
-            # 為這個連線開一個新的 Thread 去處理，主程式繼續等待下一個人
-            thread = threading.Thread(target=handle_client, args=(conn, addr))
-            thread.daemon = True # 設定為 Daemon，Server 關閉時 Thread 會自動跟著關
-            thread.start()
-            
-            print(f"[線上人數] 目前連線數: {threading.active_count() - 1}")
+    raise_fd_limit()
 
+    try:
+        asyncio.run(serve())
     except KeyboardInterrupt:
         print("\n[關閉] Server 正在關閉...")
     finally:
-        server.close()
+        db_executor.shutdown(wait=False)
+        io_executor.shutdown(wait=False)
+        package_executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     from db_server import init_db
     init_db()
-    start_server()
\ No newline at end of file
+    start_server()
@@ -0,0 +1,157 @@
+# tests/test_codec.py
+"""
+common/codec.py 純 Python 編解碼 (_py_packb / _py_unpackb) 的 round-trip 測試
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+from common import codec
+from common.codec import ExtType, _py_packb, _py_unpackb
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# 各長度標頭 (fix / 8 / 16 / 32 bit) 的邊界值
+INTS = [0, 1, 0x7f, 0x80, 0xff, 0x100, 0xffff, 0x10000, 0xffffffff, 0x100000000, 0xffffffffffffffff,
+        -1, -32, -33, -0x80, -0x81, -0x8000, -0x8001, -0x80000000, -0x80000001, -0x8000000000000000]
+STR_LENGTHS = [0, 31, 32, 0xff, 0x100, 0xffff, 0x10000]
+CONTAINER_LENGTHS = [0, 15, 16, 0xffff, 0x10000]
+
+
+def tetris_state():
+    board = [[(x * 7 + y) % 8 for x in range(10)] for y in range(20)]
+    player = {"board": board, "x": 4, "y": 3, "shape": [[0, 1, 0], [1, 1, 1]], "dead": False, "score": 1200}
+    return {"cmd": "state", "p1": player, "p2": player}
+
+
+class PurePythonRoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, obj, expected=None):
+        self.assertEqual(_py_unpackb(_py_packb(obj)), obj if expected is None else expected)
+
+    def test_scalars(self):
+        for obj in (None, True, False, 0.0, -1.5, 3.141592653589793, 1e300, "", "大廳", b"", b"\x00\xff"):
+            with self.subTest(obj=obj):
+                self.assertRoundTrip(obj)
+
+    def test_int_boundaries(self):
+        for n in INTS:
+            with self.subTest(n=n):
+                self.assertRoundTrip(n)
+                self.assertIs(type(_py_unpackb(_py_packb(n))), int)
+
+    def test_int_out_of_range(self):
+        for n in (0x10000000000000000, -0x8000000000000001):
+            with self.subTest(n=n):
+                self.assertRaises(ValueError, _py_packb, n)
+
+    def test_str_and_bin_lengths(self):
+        for n in STR_LENGTHS:
+            with self.subTest(n=n):
+                self.assertRoundTrip("a" * n)
+                self.assertRoundTrip(b"\x01" * n)
+
+    def test_multibyte_str_uses_encoded_length(self):
+        self.assertRoundTrip("遊" * 20)   # 60 bytes，超過 fixstr 的 31
+
+    def test_container_lengths(self):
+        for n in CONTAINER_LENGTHS:
+            with self.subTest(n=n):
+                self.assertRoundTrip([None] * n)
+                self.assertRoundTrip({str(i): i for i in range(n)})
+
+    def test_tuple_decodes_as_list(self):
+        self.assertRoundTrip((1, "a", None), [1, "a", None])
+
+    def test_non_str_map_keys(self):
+        self.assertRoundTrip({1: "a", -5: "b", None: [1]})
+
+    def test_uint8_array_ext(self):
+        row = [0, 1, 2, 255, 7, 0, 3, 4, 9, 10]
+        packed = _py_packb(row)
+        self.assertEqual(packed[0], 0xc7)   # ext 8，不是逐一編碼的 array
+        self.assertRoundTrip(row)
+
+    def test_uint8_array_ext_fixed_sizes(self):
+        # 長度剛好是 fixext 8 / 16 的情況
+        for n in (8, 16, 17, 0x100, 0x10000):
+            with self.subTest(n=n):
+                self.assertRoundTrip([i % 256 for i in range(n)])
+
+    def test_lists_not_packed_as_uint8(self):
+        for obj in ([0] * 7, [True] * 8, [1, 2, 3, 4, 5, 6, 7, 256], [1, 2, 3, 4, 5, 6, 7, -1], [1.0] * 8):
+            with self.subTest(obj=obj):
+                self.assertNotIn(_py_packb(obj)[0], (0xc7, 0xd7, 0xd8))
+                self.assertRoundTrip(obj)
+
+    def test_ext_type(self):
+        for data in (b"x", b"xy", b"abcd", b"12345678", b"0123456789abcdef", b"abc", b"z" * 300, b"z" * 0x10000):
+            with self.subTest(n=len(data)):
+                self.assertRoundTrip(ExtType(5, data))
+        self.assertRoundTrip(ExtType(-3, b"neg"))
+
+    def test_nested_game_state(self):
+        state = tetris_state()
+        self.assertRoundTrip(state)
+        self.assertLess(len(_py_packb(state)), len(str(state).encode()))
+
+    def test_float32_decodes(self):
+        self.assertEqual(_py_unpackb(b"\xca\x3f\xc0\x00\x00"), 1.5)
+
+    def test_truncated(self):
+        # 每一種型別的每一個前綴都必須是 ValueError，不能是 struct.error 或被當成「多出來的資料」
+        samples = [0xffff, -0x8000, 0xffffffffffffffff, 1.5, "大廳", "a" * 40, "a" * 300, b"\x00" * 300,
+                   [1] * 20, {"board": [[1] * 10] * 20, "name": "snake"}, ExtType(5, b"abcd"), ExtType(5, b"abc")]
+        for obj in samples:
+            packed = _py_packb(obj)
+            for end in range(len(packed)):
+                with self.subTest(obj=obj, end=end):
+                    self.assertRaises(ValueError, _py_unpackb, packed[:end])
+
+    def test_truncated_headers(self):
+        for data in (b"\xcd\x00", b"\xcb\x00", b"\xa5ab", b"\xd9\x05ab", b"\xda\x00", b"\xc4\x05a",
+                     b"\xd6\x05ab", b"\xc7\x05\x05ab", b"\xdc\x00\x03\x01"):
+            with self.subTest(data=data):
+                self.assertRaises(ValueError, _py_unpackb, data)
+
+    def test_extra_data(self):
+        self.assertRaises(ValueError, _py_unpackb, _py_packb(1) + b"\x00")
+
+    def test_unknown_type_byte(self):
+        self.assertRaises(ValueError, _py_unpackb, b"\xc1")
+
+    def test_unsupported_type(self):
+        self.assertRaises(TypeError, _py_packb, {1, 2})
+
+    def test_accepts_memoryview(self):
+        self.assertEqual(_py_unpackb(memoryview(_py_packb([1, "a"]))), [1, "a"])
+
+
+@unittest.skipIf(msgpack is None, "msgpack 未安裝")
+class MsgpackInteropTest(unittest.TestCase):
+    """純 Python 版與 C 實作的輸出必須可以互通"""
+
+    SAMPLES = [None, True, 0, -33, 0xffffffff, -0x80000001, 2.5, "", "遊戲" * 40, b"\x00" * 300,
+               list(range(20)), {"a": [1, 2, {"b": None}]}, ExtType(7, b"abc")]
+
+    def test_c_decodes_python_output(self):
+        for obj in self.SAMPLES + [tetris_state()]:
+            with self.subTest(obj=obj):
+                self.assertEqual(codec.unpackb(_py_packb(obj)), _py_unpackb(_py_packb(obj)))
+
+    def test_python_decodes_c_output(self):
+        for obj in self.SAMPLES + [tetris_state()]:
+            with self.subTest(obj=obj):
+                self.assertEqual(_py_unpackb(codec.packb(obj)), codec.unpackb(codec.packb(obj)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+# tests/test_db_server.py
+"""
+server/db_server.py 的寫入執行緒、交易與分頁測試 (使用暫存資料夾中的資料庫)
+
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(current_dir), "server"))
+
+import db_server
+
+WAIT = 10  # 等待 Future 的秒數上限，寫入執行緒卡住時測試會失敗而不是掛住
+
+_tmp_dir = None
+
+
+def setUpModule():
+    # 寫入執行緒與各執行緒的連線會一直沿用，整個模組共用同一個暫存資料庫
+    global _tmp_dir
+    _tmp_dir = tempfile.mkdtemp(prefix="db_server_test_")
+    db_server.DB_PATH = os.path.join(_tmp_dir, "game_store.db")
+    db_server.BUSY_TIMEOUT = 0.2
+    db_server.init_db()
+
+
+def tearDownModule():
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
+
+
+def query(sql, params=()):
+    return db_server.get_db_connection().execute(sql, params).fetchall()
+
+
+def add_game(name, description="d", author="dev"):
+    return db_server.add_game(name, "1.0", description, f"{name}.zip", author, 2, None).result(WAIT)
+
+
+class WriterFailureTest(unittest.TestCase):
+    def test_begin_failure_fails_whole_batch(self):
+        # 另一條連線持有寫入鎖，BEGIN IMMEDIATE 等到 BUSY_TIMEOUT 後失敗：整批的 Future 都要收到例外
+        blocker = sqlite3.connect(db_server.DB_PATH, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        try:
+            with mock.patch.object(db_server, "GROUP_COMMIT_WINDOW", 0.2):
+                futures = [db_server.register_user(f"locked{i}", "p") for i in range(3)]
+                for future in futures:
+                    with self.subTest(future=future):
+                        self.assertRaises(sqlite3.OperationalError, future.result, WAIT)
+        finally:
+            blocker.rollback()
+            blocker.close()
+        self.assertTrue(db_server.register_user("after_lock", "p").result(WAIT))
+
+    def test_release_failure_fails_remaining_ops(self):
+        # op 自己 RELEASE 掉 savepoint，寫入執行緒的 RELEASE op 失敗；同一批後面還沒開始的工作也不能卡住
+        with mock.patch.object(db_server, "GROUP_COMMIT_WINDOW", 0.2):
+            broken = db_server.submit_write(lambda conn: conn.execute("RELEASE op"))
+            later = db_server.register_user("after_broken", "p")
+            self.assertRaises(sqlite3.OperationalError, broken.result, WAIT)
+            self.assertRaises(sqlite3.OperationalError, later.result, WAIT)
+        self.assertEqual(query("SELECT COUNT(*) FROM users WHERE username = 'after_broken'")[0][0], 0)
+
+    def test_failed_op_only_rolls_back_itself(self):
+        def fail(conn):
+            conn.execute("INSERT INTO users (username, password) VALUES ('half_done', 'p')")
+            raise RuntimeError("boom")
+
+        with mock.patch.object(db_server, "GROUP_COMMIT_WINDOW", 0.2):
+            first = db_server.register_user("batch_ok1", "p")
+            failed = db_server.submit_write(fail)
+            last = db_server.register_user("batch_ok2", "p")
+            self.assertTrue(first.result(WAIT))
+            self.assertRaises(RuntimeError, failed.result, WAIT)
+            self.assertTrue(last.result(WAIT))
+        names = {row[0] for row in query("SELECT username FROM users")}
+        self.assertIn("batch_ok1", names)
+        self.assertIn("batch_ok2", names)
+        self.assertNotIn("half_done", names)
+
+
+class GameWriteAtomicityTest(unittest.TestCase):
+    def setUp(self):
+        if not db_server.search_index(db_server.get_db_connection()):
+            self.skipTest("SQLite 沒有 FTS5")
+
+    def test_add_game_duplicate_name(self):
+        self.assertTrue(add_game("dup"))
+        self.assertFalse(add_game("dup"))
+
+    def test_add_game_rolls_back_when_search_index_fails(self):
+        # games_fts 先佔用下一個 game_id，第二個 INSERT 失敗時 games 的那一筆也要一起撤銷
+        next_id = query("SELECT COALESCE(MAX(seq), 0) + 1 FROM sqlite_sequence WHERE name = 'games'")[0][0]
+        db_server.submit_write(lambda conn: conn.execute(
+            "INSERT INTO games_fts (rowid, name, description, author_username) VALUES (?, 'x', 'x', 'x')", (next_id,))).result(WAIT)
+        with self.assertRaises(sqlite3.DatabaseError):
+            add_game("fts_conflict")
+        self.assertEqual(query("SELECT COUNT(*) FROM games WHERE name = 'fts_conflict'")[0][0], 0)
+        db_server.submit_write(lambda conn: conn.execute("DELETE FROM games_fts WHERE rowid = ?", (next_id,))).result(WAIT)
+
+    def test_update_rolls_back_when_search_index_fails(self):
+        add_game("upd", description="old")
+        db_server.submit_write(lambda conn: conn.execute("ALTER TABLE games_fts RENAME TO games_fts_off")).result(WAIT)
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                db_server.update_game_version_db("upd", "dev", "2.0", "new", 2, "digest2").result(WAIT)
+        finally:
+            db_server.submit_write(lambda conn: conn.execute("ALTER TABLE games_fts_off RENAME TO games_fts")).result(WAIT)
+        row = query("SELECT version, description, digest FROM games WHERE name = 'upd'")[0]
+        self.assertEqual(tuple(row), ("1.0", "old", None))
+
+    def test_delete_removes_both(self):
+        add_game("gone")
+        self.assertTrue(db_server.delete_game_db("gone", "dev").result(WAIT))
+        self.assertEqual(query("SELECT COUNT(*) FROM games WHERE name = 'gone'")[0][0], 0)
+        self.assertEqual(query("SELECT COUNT(*) FROM games_fts WHERE name = 'gone'")[0][0], 0)
+
+
+class PaginationTest(unittest.TestCase):
+    AUTHOR = "pager"
+
+    @classmethod
+    def setUpClass(cls):
+        # 12 款遊戲：評分與更新時間都有大量相同值，keyset 必須靠 game_id 分出先後
+        for i in range(12):
+            add_game(f"page_{i:02d}", author=cls.AUTHOR)
+        db_server.submit_write(lambda conn: conn.execute(
+            "UPDATE games SET avg_rating = (game_id % 3) * 1.5, updated_at = 1000 + (game_id % 2) "
+            "WHERE author_username = ?", (cls.AUTHOR,))).result(WAIT)
+        db_server.submit_write(lambda conn: conn.executemany(
+            "INSERT INTO reviews (game_name, username, rating, comment) VALUES ('page_00', ?, 5, 'c')",
+            [(f"u{i}",) for i in range(7)])).result(WAIT)
+
+    def collect(self, sort, limit):
+        pages, after = [], None
+        while True:
+            games, after = db_server.list_games_page(sort, self.AUTHOR, after, limit)
+            pages.append([g['name'] for g in games])
+            if after is None:
+                return pages
+
+    def expected(self, order):
+        return [row[0] for row in query(f"SELECT name FROM games WHERE author_username = ? ORDER BY {order}", (self.AUTHOR,))]
+
+    def test_pages_cover_every_game_once(self):
+        orders = {name: sort[0] for name, sort in db_server.GAME_SORTS.items()}
+        for sort, order in orders.items():
+            for limit in (1, 5, 12, 13):
+                with self.subTest(sort=sort, limit=limit):
+                    pages = self.collect(sort, limit)
+                    self.assertEqual(sum(pages, []), self.expected(order))
+                    self.assertTrue(all(len(p) == limit for p in pages[:-1]))
+
+    def test_exact_multiple_has_no_empty_last_page(self):
+        # 剛好整除時最後一頁就是 next = None，不會多出一個空白頁
+        pages = self.collect("name", 6)
+        self.assertEqual([len(p) for p in pages], [6, 6])
+
+    def test_author_filter(self):
+        games, _ = db_server.list_games_page("name", "nobody", None, 20)
+        self.assertEqual(games, [])
+
+    def test_invalid_cursor(self):
+        for after in ("page_03", [1], [1, 2, 3], [None, 1], [[1], 2], {"a": 1}):
+            with self.subTest(after=after):
+                self.assertRaises(ValueError, db_server.list_games_page, "rating", self.AUTHOR, after, 5)
+
+    def test_review_pages(self):
+        seen, after = [], None
+        while True:
+            reviews, after = db_server.get_game_reviews("page_00", after, 3)
+            seen += [r['username'] for r in reviews]
+            if after is None:
+                break
+        self.assertEqual(seen, [f"u{i}" for i in range(7)])
+        self.assertEqual(db_server.get_game_reviews("page_00", 10 ** 9, 3), ([], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+# tests/test_player_client.py
+"""
+player/player_client.py 的斷線重連與本地安裝測試 (不需要 Server)
+
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(current_dir), "player"))
+
+import player_client
+
+
+class FakeConnection:
+    """依序回傳預先準備好的回覆；回覆是例外時拋出 (模擬斷線)"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = []
+
+    def request(self, req):
+        self.sent.append(req)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self):
+        pass
+
+
+class ReconnectTest(unittest.TestCase):
+    def make_client(self, token, after_reconnect):
+        client = player_client.PlayerClient()
+        client.user_data = {"username": "p1", "role": "player"}
+        client.token = token
+        client.sock = FakeConnection([ConnectionError("reset")])
+        client.catalog_pages = {("name", None, None): ([], None)}
+        new_conn = FakeConnection(after_reconnect)
+
+        def open_connection():
+            client.sock = new_conn
+        client.open_connection = open_connection
+        return client, new_conn
+
+    def test_without_token_drops_login(self):
+        client, new_conn = self.make_client(None, [])
+        res = client.request({"action": "LIST_ROOMS"})
+        self.assertEqual(res['status'], "FAIL")
+        self.assertIsNone(client.user_data)
+        self.assertEqual(client.catalog_pages, {})
+        self.assertEqual(new_conn.sent, [])  # 沒有登入身分，不重送
+
+    def test_rejected_resume_drops_login(self):
+        client, new_conn = self.make_client("tok", [{"status": "FAIL", "message": "登入已失效，請重新登入"}])
+        res = client.request({"action": "LIST_ROOMS"})
+        self.assertEqual(res['status'], "FAIL")
+        self.assertIsNone(client.user_data)
+        self.assertIsNone(client.token)
+        self.assertEqual([r['action'] for r in new_conn.sent], ["RESUME"])
+
+    def test_resume_retries_safe_request(self):
+        client, new_conn = self.make_client("tok", [{"status": "SUCCESS", "user": {"username": "p1"}, "rooms": {}},
+                                                    {"status": "SUCCESS", "rooms": []}])
+        res = client.request({"action": "LIST_ROOMS"})
+        self.assertEqual(res, {"status": "SUCCESS", "rooms": []})
+        self.assertEqual(client.user_data['username'], "p1")
+        self.assertEqual([r['action'] for r in new_conn.sent], ["RESUME", "LIST_ROOMS"])
+
+    def test_resume_does_not_retry_unsafe_request(self):
+        client, new_conn = self.make_client("tok", [{"status": "SUCCESS", "user": {"username": "p1"}, "rooms": {}}])
+        res = client.request({"action": "CREATE_ROOM", "game_id": "g"})
+        self.assertEqual(res['status'], "FAIL")
+        self.assertIsNotNone(client.user_data)
+
+
+class InstallSwapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="player_client_test_")
+        patcher = mock.patch.object(player_client, "current_dir", self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.client = player_client.PlayerClient()
+        self.client.user_data = {"username": "p1"}
+
+    def install(self, game_id, version, content):
+        staging = self.client.new_staging_dir(game_id)
+        with open(os.path.join(staging, "run.py"), "w") as f:
+            f.write(content)
+        self.client.save_local_manifest(staging, version, {})
+        return self.client.swap_install(game_id, staging)
+
+    def user_entries(self):
+        return sorted(os.listdir(os.path.dirname(self.client.game_dir("g"))))
+
+    def test_swap_replaces_install(self):
+        self.install("g", "1", "v1")
+        game_dir = self.install("g", "2", "v2")
+        with open(os.path.join(game_dir, "run.py")) as f:
+            self.assertEqual(f.read(), "v2")
+        self.assertEqual(self.user_entries(), ["g"])
+
+    @unittest.skipUnless(os.name == "posix", "只檢查 POSIX 權限")
+    def test_install_dir_is_not_private(self):
+        game_dir = self.install("g", "1", "v1")
+        self.assertEqual(stat.S_IMODE(os.stat(game_dir).st_mode), 0o755)
+
+    def test_interrupted_swap_is_restored(self):
+        # 模擬在兩次 rename 之間當機：安裝目錄已改名為 .old-g，staging 還沒換上
+        game_dir = self.install("g", "1", "v1")
+        os.rename(game_dir, self.client.old_install_dir("g"))
+        self.client.new_staging_dir("g")
+        other = self.client.new_staging_dir("g-x")  # 另一款遊戲 (名稱以 "g-" 開頭) 的 staging 不能被誤刪
+        self.assertEqual(self.client.get_local_version("g"), "1")
+        self.assertEqual(self.user_entries(), [os.path.basename(other), "g"])
+
+    def test_swap_after_interruption_keeps_active_staging(self):
+        game_dir = self.install("g", "1", "v1")
+        os.rename(game_dir, self.client.old_install_dir("g"))
+        stale = self.client.new_staging_dir("g")
+        self.install("g", "2", "v2")
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.client.get_local_version("g"), "2")
+        self.assertEqual(self.user_entries(), ["g"])
+
+    def test_login_cleans_up_interrupted_installs(self):
+        game_dir = self.install("g", "1", "v1")
+        os.rename(game_dir, self.client.old_install_dir("g"))
+        self.client.new_staging_dir("h")  # 第一次安裝就中斷，沒有 .old-h
+        with mock.patch.object(player_client, "Prefetcher"):
+            self.client.start_prefetch()
+        self.assertEqual(self.user_entries(), ["g"])
+
+
+class PrefetcherTest(unittest.TestCase):
+    def test_unexpected_error_does_not_kill_thread(self):
+        started, release, done = threading.Event(), threading.Event(), []
+
+        def fake_prefetch(prefetcher, game_id):
+            if game_id == "broken":
+                started.set()
+                release.wait(5)
+                raise KeyError("size")  # 缺欄位的回覆
+            done.append(game_id)
+
+        with mock.patch.object(player_client.Prefetcher, "_prefetch", fake_prefetch), \
+                mock.patch("builtins.print"):
+            prefetcher = player_client.Prefetcher()
+            self.addCleanup(prefetcher.close)
+            prefetcher.hint(["broken"])
+            self.assertTrue(started.wait(5))
+            waiter = threading.Thread(target=prefetcher.wait_for, args=("broken", 5))
+            waiter.start()
+            release.set()
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())  # 前景不會卡住，改用一般下載
+            prefetcher.hint(["next"])
+            deadline = time.monotonic() + 5
+            while not done and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(done, ["next"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+# tests/test_protocol.py
+"""
+common/protocol.py 的協商與 framing 測試
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+from common import protocol
+from common.protocol import CODEC_BINARY, CODEC_JSON, choose_codec
+
+
+class ChooseCodecTest(unittest.TestCase):
+    def test_unaccelerated_server_prefers_json(self):
+        with mock.patch.object(protocol.codec, "ACCELERATED", False):
+            self.assertEqual(choose_codec([CODEC_BINARY, CODEC_JSON]), CODEC_JSON)
+            self.assertEqual(choose_codec([CODEC_BINARY]), CODEC_BINARY)  # 只會 msgpack 的 Client 仍然可以連
+
+    def test_accelerated_server_follows_client_order(self):
+        with mock.patch.object(protocol.codec, "ACCELERATED", True):
+            self.assertEqual(choose_codec([CODEC_BINARY, CODEC_JSON]), CODEC_BINARY)
+            self.assertEqual(choose_codec([CODEC_JSON, CODEC_BINARY]), CODEC_JSON)
+
+    def test_unknown_or_missing_offer(self):
+        for offered in (None, [], ["cbor"], ["cbor", CODEC_BINARY]):
+            with self.subTest(offered=offered):
+                self.assertIn(choose_codec(offered), (CODEC_JSON, CODEC_BINARY))
+        self.assertEqual(choose_codec(None), CODEC_JSON)
+        self.assertEqual(choose_codec(["cbor"]), CODEC_JSON)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+# tests/test_server.py
+"""
+server/server.py 中不需要網路的部分：session token、續傳 offset 等
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(current_dir), "server"))
+
+import server
+from common.protocol import CHUNK_HEADER, TRANSFER_CHUNKED
+
+USER = {"username": "p1", "role": "player"}
+
+
+class SessionTokenTest(unittest.TestCase):
+    def setUp(self):
+        server.sessions.clear()
+
+    def test_issue_and_resume(self):
+        token = server.issue_session(USER)
+        self.assertEqual(server.resume_session(token), USER)
+
+    def test_tampered_token(self):
+        sid, expires, signature = server.issue_session(USER).split(".")
+        for token in (f"{sid}.{expires}.{'0' * len(signature)}", f"{sid}.{int(expires) + 60}.{signature}",
+                      f"x{sid}.{expires}.{signature}", "garbage", "", None, 12345):
+            with self.subTest(token=token):
+                self.assertIsNone(server.resume_session(token))
+
+    def test_expired_token(self):
+        token = server.issue_session(USER)
+        with mock.patch.object(server.time, "time", return_value=time.time() + server.SESSION_TTL + 1):
+            self.assertIsNone(server.resume_session(token))
+
+    def test_revoked_token(self):
+        token = server.issue_session(USER)
+        server.revoke_session(token)
+        self.assertIsNone(server.resume_session(token))
+
+    def test_expired_sessions_are_pruned(self):
+        server.issue_session(USER)
+        with mock.patch.object(server.time, "time", return_value=time.time() + server.SESSION_TTL + 1):
+            server.issue_session(USER)
+        self.assertEqual(len(server.sessions), 1)
+
+
+class PageLimitTest(unittest.TestCase):
+    def test_bounds(self):
+        for limit, expected in [(None, server.PAGE_SIZE), (0, server.PAGE_SIZE), (5, 5), (-3, 1),
+                                (10 ** 6, server.MAX_PAGE_SIZE), ("7", 7), ("abc", server.PAGE_SIZE), ([1], server.PAGE_SIZE)]:
+            with self.subTest(limit=limit):
+                self.assertEqual(server.page_limit({"limit": limit}), expected)
+
+
+class DownloadOffsetTest(unittest.TestCase):
+    SHA = "a" * 64
+
+    def offset(self, size=100, **request):
+        return server.download_offset(request, self.SHA, size)
+
+    def test_resume(self):
+        self.assertEqual(self.offset(), 0)
+        self.assertEqual(self.offset(offset=None), 0)
+        self.assertEqual(self.offset(offset=40), 40)
+        self.assertEqual(self.offset(offset=40, if_sha256=self.SHA), 40)
+        # 上次已收完整個檔案：回覆 size 後不再送資料
+        self.assertEqual(self.offset(offset=100, if_sha256=self.SHA), 100)
+
+    def test_invalid_offset(self):
+        for offset in [101, -1, "40", 4.0, True, [40]]:
+            with self.subTest(offset=offset):
+                self.assertIsNone(self.offset(offset=offset, if_sha256=self.SHA))
+
+    def test_changed_version_restarts(self):
+        # 舊版本的暫存檔比新版本大時也要從頭送，而不是回報超出範圍
+        self.assertEqual(self.offset(offset=40, if_sha256="b" * 64), 0)
+        self.assertEqual(self.offset(offset=500, if_sha256="b" * 64), 0)
+
+
+class RemoveArtifactsTest(unittest.TestCase):
+    def setUp(self):
+        self.store = tempfile.mkdtemp(prefix="store_test_")
+        self.addCleanup(shutil.rmtree, self.store, True)
+        patcher = mock.patch.object(server, "STORE_DIR", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make(self, name, age=0):
+        path = os.path.join(self.store, name)
+        os.makedirs(os.path.join(path, "package"))
+        if age:
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+
+    def test_keeps_live_and_fresh_staging(self):
+        self.make("live")
+        self.make("dead")
+        self.make(".staging-fresh")
+        self.make(".staging-stale", age=server.UPLOAD_JOB_TTL + 60)
+        self.assertEqual(server.remove_artifacts({"live"}), 2)
+        self.assertEqual(sorted(os.listdir(self.store)), [".staging-fresh", "live"])
+        self.assertEqual(server.remove_artifacts({"live"}), 0)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TakeOverLoginTest(unittest.TestCase):
+    def setUp(self):
+        server.online_users.clear()
+
+    def test_new_connection_replaces_stale_one(self):
+        old, new = FakeConnection(), FakeConnection()
+        server.take_over_login("p1", old)
+        server.take_over_login("p1", new)
+        self.assertTrue(old.closed)
+        self.assertFalse(new.closed)
+        self.assertIs(server.online_users["p1"], new)
+
+    def test_same_connection_is_kept(self):
+        conn = FakeConnection()
+        server.take_over_login("p1", conn)
+        server.take_over_login("p1", conn)
+        self.assertFalse(conn.closed)
+
+
+class FakeUploadConnection:
+    """依序交出預先準備好的 frame 與 JSON 訊息"""
+
+    def __init__(self, frames, trailer=None):
+        self.frames = list(frames)
+        self.trailer = trailer
+
+    async def recv_frame(self):
+        if not self.frames:
+            raise ConnectionError("socket connection broken while receiving")
+        return self.frames.pop(0)
+
+    async def recv_json(self):
+        return self.trailer
+
+
+def chunk(offset, data):
+    return CHUNK_HEADER.pack(offset) + data
+
+
+class ReceiveFileTest(unittest.TestCase):
+    DATA = os.urandom(3000)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="server_test_")
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.zip_path = os.path.join(self.tmp, "upload.zip")
+
+    def receive(self, frames, sha256=None, size=None):
+        conn = FakeUploadConnection(frames, {"sha256": sha256 or hashlib.sha256(self.DATA).hexdigest()})
+        request = {"size": len(self.DATA) if size is None else size, "transfer": TRANSFER_CHUNKED}
+        return asyncio.run(server.receive_file(conn, self.zip_path, request))
+
+    def chunks(self, size=1000):
+        return [chunk(o, self.DATA[o:o + size]) for o in range(0, len(self.DATA), size)]
+
+    def assertNothingLeft(self):
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_complete_upload(self):
+        digest = self.receive(self.chunks())
+        self.assertEqual(digest, hashlib.sha256(self.DATA).hexdigest())
+        with open(self.zip_path, "rb") as f:
+            self.assertEqual(f.read(), self.DATA)
+
+    def test_out_of_order_offset(self):
+        frames = self.chunks()
+        frames[1], frames[2] = frames[2], frames[1]
+        self.assertRaises(ValueError, self.receive, frames)
+        self.assertNothingLeft()
+
+    def test_repeated_offset(self):
+        frames = self.chunks()
+        self.assertRaises(ValueError, self.receive, frames[:2] + frames[1:])
+        self.assertNothingLeft()
+
+    def test_more_data_than_declared(self):
+        self.assertRaises(ValueError, self.receive, self.chunks(), size=len(self.DATA) - 1)
+        self.assertNothingLeft()
+
+    def test_sha256_mismatch(self):
+        self.assertRaises(ValueError, self.receive, self.chunks(), sha256="0" * 64)
+        self.assertNothingLeft()
+
+    def test_short_chunk_frame(self):
+        self.assertRaises(ValueError, self.receive, [b"\x00" * (CHUNK_HEADER.size - 1)])
+        self.assertNothingLeft()
+
+    def test_disconnect_midway(self):
+        self.assertRaises(ConnectionError, self.receive, self.chunks()[:2])
+        self.assertNothingLeft()
+
+
+if __name__ == "__main__":
+    unittest.main()